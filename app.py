@@ -0,0 +1,747 @@
+import asyncio
+import os
+import re
+import shutil
+from contextlib import AsyncExitStack, asynccontextmanager
+from io import BytesIO
+from multiprocessing import current_process
+from typing import AsyncIterator, Awaitable, Hashable, List, MutableMapping, Optional, Tuple, Union
+from uuid import uuid4
+
+import aiogram
+from aiogram import types
+from aiogram.bot.api import TelegramAPIServer
+from aiogram.dispatcher import Dispatcher, filters
+from aiogram.types import InputFile, InputMediaVideo, InputMediaAudio, InlineQuery, InlineQueryResultPhoto, InlineKeyboardMarkup, \
+    InlineKeyboardButton, InlineQueryResultCachedPhoto
+from ffmpy import FFExecutableNotFoundError, FFRuntimeError
+from funcy import chunks
+
+import config
+import encoder
+import formats
+from clip import ClipFile, download_audio_clip, download_clip, download_clip_from_segment, extract_frame, \
+    sweep_clip_dir
+from config import TOKEN, BOT_CHANNEL_ID
+from debounce import Debouncer, finish
+from file_ids import ClipKind, FileIdStore
+from formats import FormatType, get_candidate_formats, get_videofile_url
+from frames import Frame, FrameCache
+from jobs import ClipJob, LocalJobQueue, RedisJobQueue, SingleFlight, WorkerPool
+from log import make_logger
+from metrics import STAGE_SECONDS, Gauge, StatsCollector, UpdateMetricsMiddleware, start_metrics_server
+from parse import Request, find_requests, match_request, match_inline_query, request_to_start_timestamp_url, request_to_query
+from profiles import choose_profile
+from ratelimit import ApiScheduler, ScheduledBot
+from segments import SegmentCache
+from sourcecache import SourceCache, source_key
+from speculative import Speculator
+from state import MessageStore, make_store
+from supervisor import shard_name
+
+try:
+    import ujson as json
+except ImportError:
+    import json as json
+
+try:
+    import uvloop
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
+logger = make_logger(__name__)
+
+BATCH_MAX_CLIPS: int = getattr(config, 'BATCH_MAX_CLIPS', 10)
+# Bot API limit for one send_media_group
+MEDIA_GROUP_SIZE = 10
+FRAME_HEIGHT: int = getattr(config, 'FRAME_HEIGHT', 720)
+# how long an inline query or an upload waits for its frame before going without
+FRAME_TIMEOUT: float = getattr(config, 'FRAME_TIMEOUT', 3)
+# a channel of their own gives frame uploads a rate limit apart from the clips'
+FRAME_CHANNEL_ID = getattr(config, 'FRAME_CHANNEL_ID', BOT_CHANNEL_ID)
+
+# Built once per process by build_app, so that importing this module has no
+# side effects and every supervisor shard has a bot and state of its own.
+bot: ScheduledBot
+dispatcher: Dispatcher
+api_scheduler: Optional[ApiScheduler]
+file_ids: FileIdStore
+clip_jobs: SingleFlight
+upload_jobs: SingleFlight
+source_cache: Optional[SourceCache]
+segment_cache: Optional[SegmentCache]
+# warms the format cache and, optionally, the preview while the user picks a button
+speculator: Optional[Speculator]
+# every message renders only its newest text, edits wait a moment for the next keystroke
+message_renders: Debouncer
+frame_prefetches: Debouncer
+frames: Optional[FrameCache]
+job_pool: WorkerPool
+# audio has its own queue and workers, so it never waits behind video renders
+audio_pool: WorkerPool
+last_messages: MutableMapping
+# every shard of the supervisor listens on its own port, see build_app
+metrics_port: Optional[int] = None
+metrics_runner = None
+
+
+def clip_key(request: Request, kind: ClipKind, quality: FormatType) -> Hashable:
+    return (request.youtube_id, request.start, request.end, kind, quality)
+
+
+async def render_audio_job(job: ClipJob) -> ClipFile:
+    request = job.request
+    duration = request.end - request.start
+    file_url = await get_videofile_url(request.youtube_id, type_='audio', duration=duration)
+    if source_cache is not None:
+        source_ext, url = file_url
+        file_url = (source_ext, source_cache.source_url(request.youtube_id, url))
+    with encoder.accepted():
+        return await download_audio_clip(file_url, request.start, request.end,
+                                         profile=choose_profile('audio', duration))
+
+
+async def render_job(job: ClipJob) -> ClipFile:
+    request = job.request
+    duration = request.end - request.start
+    profile = choose_profile(job.quality, duration)
+    source_ext, url = await get_videofile_url(request.youtube_id, type_=job.quality, duration=duration)
+    source = source_key(request.youtube_id, url)
+    if source_cache is not None:
+        url = source_cache.source_url(request.youtube_id, url)
+
+    clip = None
+    # +N/-N buttons move only the end, so a clip with the same start can be reused
+    segment_key = (request.youtube_id, request.start, job.kind, job.quality)
+    # the pool has accepted the job, its ffmpeg runs only wait for their turn
+    with encoder.accepted():
+        if segment_cache is not None:
+            segment = segment_cache.find(segment_key, request.start, request.end, source, profile)
+            if segment is not None:
+                try:
+                    clip = await download_clip_from_segment(url, segment, request.start, request.end,
+                                                            profile=segment.profile, type_=job.kind)
+                    profile = segment.profile
+                except (FFRuntimeError, FFExecutableNotFoundError) as e:
+                    logger.warning('Reusing the rendered segment failed, rendering from scratch: %s', e)
+
+        if clip is None:
+            clip = await download_clip((source_ext, url), request.start, request.end,
+                                       profile=profile, type_=job.kind)
+    if segment_cache is not None:
+        segment_cache.put(segment_key, clip.path, request.end, source, profile)
+    return clip
+
+
+async def render_frame(youtube_id: str, second: int) -> Tuple[bytes, bytes]:
+    _, url = await get_videofile_url(youtube_id, type_='clip', duration=1)
+    if source_cache is not None:
+        url = source_cache.source_url(youtube_id, url)
+    return await extract_frame(url, second, max_height=FRAME_HEIGHT)
+
+
+async def upload_frame(photo: bytes) -> str:
+    mes = await bot.send_photo(FRAME_CHANNEL_ID, InputFile(BytesIO(photo), filename='frame.jpg'))
+    return mes.photo[-1].file_id
+
+
+
+async def wait_frame(future: Optional[Awaitable]):
+    if future is None:
+        return None
+    future = asyncio.ensure_future(future)
+    # a frame that fails after the timeout is nobody's to report
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    try:
+        # the frame keeps rendering for whoever asks next
+        return await asyncio.wait_for(asyncio.shield(future), FRAME_TIMEOUT)
+    except asyncio.TimeoutError:
+        return None
+    except Exception as e:
+        logger.warning('Frame failed: %s', e)
+        return None
+
+
+def prefetch_frame(request: Request, user_id: int) -> None:
+    # Nobody waits for it, the frame is used once the query is asked again.
+    # Each user has at most one, it starts once they stop typing for a moment,
+    # and the next keystroke cancels it together with its render and upload.
+    future = asyncio.ensure_future(frame_prefetches.run(
+        user_id, lambda: frames.file_id(request.youtube_id, request.start)))
+    future.add_done_callback(log_frame_failure)
+
+
+def log_frame_failure(future: asyncio.Future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning('Frame failed: %s', future.exception())
+
+
+def start_thumb(request: Request, quality: FormatType = 'clip') -> Optional[asyncio.Future]:
+    # renders next to the clip, it is only needed once the clip is uploaded
+    if frames is None or file_ids.get(request, 'video', quality) is not None:
+        return None
+    return asyncio.ensure_future(frames.get(request.youtube_id, request.start))
+
+
+async def thumb_for(video: Union[str, InputFile], future: Optional[asyncio.Future]) -> Optional[InputFile]:
+    # Telegram only takes a thumbnail along with a new file
+    if not isinstance(video, InputFile):
+        return None
+    frame: Optional[Frame] = await wait_frame(future)
+    return InputFile(BytesIO(frame.thumb), filename='thumb.jpg') if frame is not None else None
+
+
+def make_job_queue(name: str):
+    backend = getattr(config, 'JOB_QUEUE', 'local')
+    if backend == 'local':
+        return LocalJobQueue()
+    elif backend == 'redis':
+        return RedisJobQueue(config.REDIS_URL, prefix=name)
+    else:
+        raise ValueError(backend)
+
+
+
+@asynccontextmanager
+async def open_clip(request: Request, kind: ClipKind, quality: FormatType,
+                    chat_id: int, user_id: int) -> AsyncIterator[Union[str, InputFile]]:
+    file_id = file_ids.get(request, kind, quality)
+    if file_id is not None:
+        yield file_id
+        return
+
+    def render() -> Awaitable[ClipFile]:
+        pool = audio_pool if kind == 'audio' else job_pool
+        return pool.submit(ClipJob(request, kind, quality, chat_id=chat_id, user_id=user_id))
+
+    clip = await clip_jobs.run(clip_key(request, kind, quality), render)
+    # every waiter streams its own handle of the shared file
+    with clip.open() as f:
+        yield f
+
+
+def remember_file_id(request: Request, kind: ClipKind, quality: FormatType, mes) -> None:
+    if not isinstance(mes, types.Message):
+        return
+
+    media = mes.video if kind == 'video' else mes.audio
+    if media is not None:
+        file_ids.put(request, kind, quality, media.file_id)
+
+
+async def get_channel_file_id(request: Request, kind: ClipKind, quality: FormatType, user_id: int) -> str:
+    file_id = file_ids.get(request, kind, quality)
+    if file_id is not None:
+        return file_id
+
+    async def upload() -> str:
+        thumb = start_thumb(request, quality) if kind == 'video' else None
+        async with open_clip(request, kind, quality, chat_id=user_id, user_id=user_id) as clip:
+            if kind == 'video':
+                mes = await bot.send_video(BOT_CHANNEL_ID, clip, thumb=await thumb_for(clip, thumb))
+                file_id = mes.video.file_id
+            else:
+                mes = await bot.send_audio(BOT_CHANNEL_ID, clip)
+                file_id = mes.audio.file_id
+
+        file_ids.put(request, kind, quality, file_id)
+        return file_id
+
+    return await upload_jobs.run(clip_key(request, kind, quality), upload)
+
+
+async def handle_message(message: types.Message):
+    try:
+        try:
+            with STAGE_SECONDS.time(stage='match_request'):
+                request = match_request(message.text)
+        except ValueError as e:
+            message.reply_text(str(e))
+            return
+        else:
+            if not request:
+                with STAGE_SECONDS.time(stage='match_request'):
+                    found = find_requests(message.text)
+                if len(found) > 1:
+                    await message_renders.run((message.chat.id, message.message_id),
+                                              lambda: handle_batch(message, found), delay=0)
+                return
+
+        logger.info("Message: %s, request: %s", message.text, request)
+        # an edit of the message arriving meanwhile replaces this render
+        await message_renders.run((message.chat.id, message.message_id),
+                                  lambda: send_clip(message, request), delay=0)
+    except Exception as e:
+        logger.exception(e)
+
+
+async def send_clip(message: types.Message, request: Request) -> None:
+    await bot.send_chat_action(message.chat.id, aiogram.types.chat.ChatActions.UPLOAD_VIDEO)
+
+    thumb = start_thumb(request)
+    async with open_clip(request, 'video', 'clip',
+                         chat_id=message.chat.id, user_id=message.from_user.id) as video:
+        thumb_file = await thumb_for(video, thumb)
+
+        async def upload() -> None:
+            video_mes = await bot.send_video(message.chat.id, video,
+                                             reply_to_message_id=message.message_id,
+                                             caption=request_to_start_timestamp_url(request),
+                                             thumb=thumb_file)
+            remember_file_id(request, 'video', 'clip', video_mes)
+            last_messages[(message.chat.id, message.message_id)] = video_mes.message_id
+
+        # an edit of the message may cancel the render, but not a sent clip
+        await finish(upload())
+
+
+async def handle_batch(message: types.Message, found: List[Union[Request, ValueError]]) -> None:
+    requests = [r for r in found if isinstance(r, Request)][:BATCH_MAX_CLIPS]
+    errors = [str(e) for e in found if isinstance(e, ValueError)]
+    logger.info("Message: %s, batch: %s", message.text, requests)
+
+    if requests:
+        await bot.send_chat_action(message.chat.id, aiogram.types.chat.ChatActions.UPLOAD_VIDEO)
+
+        # one extraction per video, however many ranges of it are asked for
+        await asyncio.gather(*(get_candidate_formats(youtube_id, 'clip')
+                               for youtube_id in {r.youtube_id for r in requests}),
+                             return_exceptions=True)
+
+        thumbs = [start_thumb(r) for r in requests]
+        async with AsyncExitStack() as clips:
+            # the clips render in parallel, as far as the worker pool allows
+            opened = await asyncio.gather(*(clips.enter_async_context(
+                open_clip(r, 'video', 'clip', chat_id=message.chat.id, user_id=message.from_user.id))
+                for r in requests), return_exceptions=True)
+
+            rendered = []
+            for request, video, thumb in zip(requests, opened, thumbs):
+                if isinstance(video, BaseException):
+                    logger.warning('Batch clip %s failed: %s', request, video)
+                    errors.append(f'{request_to_start_timestamp_url(request)}: failed')
+                else:
+                    rendered.append((request, video, thumb))
+
+            async def upload(group, thumb_files) -> None:
+                if len(group) == 1:
+                    (request, video, _), = group
+                    sent = [await bot.send_video(message.chat.id, video,
+                                                 reply_to_message_id=message.message_id,
+                                                 caption=request_to_start_timestamp_url(request),
+                                                 thumb=thumb_files[0])]
+                else:
+                    sent = await bot.send_media_group(
+                        message.chat.id,
+                        [InputMediaVideo(video, caption=request_to_start_timestamp_url(request), thumb=thumb_file)
+                         for (request, video, _), thumb_file in zip(group, thumb_files)],
+                        reply_to_message_id=message.message_id,
+                    )
+                for (request, _, _), mes in zip(group, sent):
+                    remember_file_id(request, 'video', 'clip', mes)
+
+            for group in chunks(MEDIA_GROUP_SIZE, rendered):
+                thumb_files = [await thumb_for(video, thumb) for _, video, thumb in group]
+                await finish(upload(group, thumb_files))
+
+    if errors:
+        await message.reply('\n'.join(errors))
+
+
+async def handle_message_edit(message: types.Message):
+    try:
+        # a newer edit cancels this one, together with its download and ffmpeg
+        await message_renders.run((message.chat.id, message.message_id), lambda: edit_clip(message))
+    except Exception as e:
+        logger.exception(e)
+
+
+async def edit_clip(message: types.Message) -> None:
+    try:
+        video_mes_id = last_messages[(message.chat.id, message.message_id)]
+    except KeyError:
+        know_message = False
+    else:
+        know_message = True
+
+    try:
+        with STAGE_SECONDS.time(stage='match_request'):
+            request = match_request(message.text)
+    except ValueError as e:
+        if know_message:
+            await bot.edit_message_caption(message.chat.id, video_mes_id, caption=str(e))
+        else:
+            await message.answer(str(e))
+        return
+    else:
+        if not request:
+            return
+
+    logger.info("Message: %s, request: %s", message.text, request)
+
+    await bot.send_chat_action(message.chat.id, aiogram.types.chat.ChatActions.UPLOAD_VIDEO)
+
+    thumb = start_thumb(request)
+    async with open_clip(request, 'video', 'clip',
+                         chat_id=message.chat.id, user_id=message.from_user.id) as video:
+        thumb_file = await thumb_for(video, thumb)
+
+        async def upload() -> None:
+            if know_message:
+                video_mes = await bot.edit_message_media(chat_id=message.chat.id,
+                                                         message_id=video_mes_id,
+                                                         media=InputMediaVideo(video,
+                                                                               thumb=thumb_file,
+                                                                               caption=request_to_start_timestamp_url(request)))
+            else:
+                video_mes = await bot.send_video(message.chat.id, video,
+                                                 reply_to_message_id=message.message_id,
+                                                 caption=request_to_start_timestamp_url(request),
+                                                 thumb=thumb_file)
+            remember_file_id(request, 'video', 'clip', video_mes)
+
+            if not know_message:
+                last_messages[(message.chat.id, message.message_id)] = video_mes.message_id
+
+        # a newer edit waits for this upload, so it knows the clip's message
+        await finish(upload())
+
+
+def make_inline_keyboard(user_id: int, request: Request) -> InlineKeyboardMarkup:
+    keyboard = [
+        [('+1',  1), ('+2',  2), ('+5',  5), ('+10',  10), ('+30',  30)],
+        [('-1', -1), ('-2', -2), ('-5', -5), ('-10', -10), ('-30', -30)],
+        [('Предпросмотр', 'preview')],
+        [('Видео', 'video'), ('Аудио', 'audio')],
+    ]
+
+    return InlineKeyboardMarkup(
+        row_width=1,
+        inline_keyboard=[
+            [
+                types.InlineKeyboardButton(
+                    text,
+                    callback_data=f'{user_id} {request.youtube_id} {request.start} {request.end} {action}',
+                )
+                for text, action in row
+            ]
+            for row in keyboard
+        ],
+    )
+
+
+async def inline_query(inline_query: InlineQuery) -> None:
+    try:
+        query = inline_query.query
+
+        try:
+            with STAGE_SECONDS.time(stage='match_request'):
+                request = match_inline_query(query)
+        except ValueError:
+            await bot.answer_inline_query(inline_query.id, [])
+            return
+
+        if request is None:
+            await bot.answer_inline_query(inline_query.id, [])
+            return
+
+        if speculator is not None:
+            speculator.speculate(('formats', request.youtube_id), inline_query.from_user.id,
+                                 lambda: warm_formats(request.youtube_id))
+
+        frame_file_id = None
+        if frames is not None:
+            # an inline query is answered right away, every keystroke is a new query
+            frame_file_id = frames.cached_file_id(request.youtube_id, request.start)
+            if frame_file_id is None:
+                prefetch_frame(request, inline_query.from_user.id)
+
+        if frame_file_id is not None:
+            result = InlineQueryResultCachedPhoto(
+                id=str(uuid4()),
+                photo_file_id=frame_file_id,
+                reply_markup=make_inline_keyboard(inline_query.from_user.id, request),
+                caption=request_to_query(request),
+            )
+        else:
+            result = InlineQueryResultPhoto(
+                id=str(uuid4()),
+                title="",
+                photo_url="https://i.ytimg.com/vi/{id}/maxresdefault.jpg".format(id=request.youtube_id),
+                thumb_url="https://i.ytimg.com/vi/{id}/mqdefault.jpg".format(id=request.youtube_id),
+                reply_markup=make_inline_keyboard(inline_query.from_user.id, request),
+                caption=request_to_query(request),
+            )
+        # without the frame, ask again soon instead of keeping the video's cover for a day
+        cache_time = 60 * 60 * 24 if frame_file_id is not None or frames is None else 10
+        await bot.answer_inline_query(inline_query.id, [result], cache_time=cache_time)
+    except Exception as e:
+        logger.exception("a")
+
+
+async def warm_formats(youtube_id: str) -> None:
+    await asyncio.gather(get_candidate_formats(youtube_id, 'preview'),
+                         get_candidate_formats(youtube_id, 'clip'))
+
+
+async def chosen_inline_result(chosen: types.ChosenInlineResult) -> None:
+    try:
+        if speculator is None:
+            return
+
+        with STAGE_SECONDS.time(stage='match_request'):
+            request = match_inline_query(chosen.query)
+        if request is None:
+            return
+
+        user_id = chosen.from_user.id
+        if getattr(config, 'SPECULATIVE_PREVIEW', False):
+            # the upload is shared with the callback if the user presses the button meanwhile
+            speculator.speculate(clip_key(request, 'video', 'preview'), user_id,
+                                 lambda: get_channel_file_id(request, 'video', 'preview', user_id))
+        else:
+            speculator.speculate(('formats', request.youtube_id), user_id,
+                                 lambda: warm_formats(request.youtube_id))
+    except Exception as e:
+        logger.exception(e)
+
+
+async def inline_kb_answer_callback_handler(callback_query: types.CallbackQuery):
+    try:
+        user_id, youtube_id, start, end, action = callback_query.data.split()
+
+        if callback_query.from_user.id != int(user_id):
+            await callback_query.answer(text='You shall not press!')
+            return
+
+        request = Request(youtube_id=youtube_id, start=int(start), end=int(end))
+
+        if speculator is not None and action in ['video', 'audio', 'preview']:
+            speculator.claim(clip_key(request, 'video', 'preview') if action == 'preview'
+                             else ('formats', request.youtube_id))
+
+        if action in ['video', 'audio']:
+            await bot.edit_message_caption(
+                inline_message_id=callback_query.inline_message_id,
+                reply_markup=InlineKeyboardMarkup(
+                    row_width=1,
+                    inline_keyboard=[
+                        [
+                            types.InlineKeyboardButton(
+                                'Загружаем...',
+                                url=request_to_start_timestamp_url(request),
+                            )
+                        ]
+                    ],
+                ),
+                caption=request_to_start_timestamp_url(request),
+            )
+
+        if action == 'video':
+            file_id = await get_channel_file_id(request, 'video', 'clip', callback_query.from_user.id)
+            await bot.edit_message_media(
+                inline_message_id=callback_query.inline_message_id,
+                media=InputMediaVideo(
+                    file_id,
+                    caption=request_to_start_timestamp_url(request)
+                )
+            )
+        elif action == 'audio':
+            file_id = await get_channel_file_id(request, 'audio', 'audio', callback_query.from_user.id)
+            await bot.edit_message_media(
+                inline_message_id=callback_query.inline_message_id,
+                media=InputMediaAudio(
+                    file_id,
+                    caption=request_to_start_timestamp_url(request)
+                ),
+            )
+        elif action == 'preview':
+            file_id = await get_channel_file_id(request, 'video', 'preview', callback_query.from_user.id)
+            await bot.edit_message_media(
+                inline_message_id=callback_query.inline_message_id,
+                media=InputMediaVideo(
+                    file_id,
+                    caption=request_to_query(request),
+                ),
+                reply_markup=make_inline_keyboard(callback_query.from_user.id, request),
+            )
+        else:
+            delta = int(action)
+            request.end += delta
+
+            await bot.edit_message_caption(
+                inline_message_id=callback_query.inline_message_id,
+                reply_markup=make_inline_keyboard(callback_query.from_user.id, request),
+                caption=request_to_query(request),
+            )
+        await callback_query.answer()
+    except Exception as e:
+        logger.exception("a")
+
+
+async def error_handler(update: types.Update, exception: Exception):
+    logger.warning('Update "%s" caused error "%s"', update, exception)
+
+
+def make_bot(loop: asyncio.AbstractEventLoop, scheduler: Optional[ApiScheduler] = None) -> ScheduledBot:
+    return ScheduledBot(token=TOKEN, loop=loop, scheduler=scheduler,
+                        server=TelegramAPIServer.from_base(getattr(config, 'TELEGRAM_API_URL', 'https://api.telegram.org')))
+
+
+def register_handlers(dispatcher: Dispatcher) -> None:
+    dispatcher.middleware.setup(UpdateMetricsMiddleware())
+    dispatcher.register_message_handler(handle_message, filters.Text(contains="https", ignore_case=False))
+    dispatcher.register_edited_message_handler(handle_message_edit, filters.Text(contains="https", ignore_case=False))
+    dispatcher.register_inline_handler(inline_query)
+    dispatcher.register_chosen_inline_handler(chosen_inline_result)
+    dispatcher.register_callback_query_handler(inline_kb_answer_callback_handler, lambda callback_query: True)
+    dispatcher.register_errors_handler(error_handler)
+
+
+# names of the directories process_cache_dir has made, including the pid
+# directories of earlier versions; anything else in the root is left alone
+CACHE_DIR_NAME = re.compile(r'\d+|shard-\d+|MainProcess')
+
+
+def process_cache_dir(root: str, shard_index: Optional[int], shards: int) -> str:
+    # Every process gets its own directory, a shard must not wipe another
+    # shard's files. The name survives restarts, and directories no current
+    # process owns, e.g. of a shard that is no longer configured, are removed.
+    owners = {shard_name(i) for i in range(shards)} if shard_index is not None else {current_process().name}
+    if os.path.isdir(root):
+        for entry in os.scandir(root):
+            if (entry.name not in owners and CACHE_DIR_NAME.fullmatch(entry.name)
+                    and entry.is_dir(follow_symlinks=False)):
+                shutil.rmtree(entry.path, ignore_errors=True)
+    return os.path.join(root, current_process().name)
+
+
+def make_last_messages() -> MutableMapping:
+    # not STATE_BACKEND, which also picks the format cache's store
+    backend = getattr(config, 'LAST_MESSAGES_BACKEND', 'compact')
+    if backend == 'compact':
+        # shards see disjoint chats, so each keeps its own files
+        state_file = getattr(config, 'STATE_FILE', None)
+        return MessageStore(getattr(config, 'STATE_BYTES', 32 * 2 ** 20),
+                            path=f'{state_file}.{current_process().name}' if state_file else None)
+    else:
+        return make_store(backend, getattr(config, 'STATE_DB', 'state.sqlite3'),
+                          'last_messages', maxsize=1000, ttl=86400)
+
+
+def register_metrics() -> None:
+    # called once per process, a registry rejects a second metric of the same name
+    if isinstance(last_messages, MessageStore):
+        StatsCollector('clipbot_last_messages', 'Message to clip lookups, see state.MessageStoreStats.',
+                       last_messages.stats)
+        Gauge('clipbot_last_messages_entries', 'Messages with a known clip message.',
+              function=lambda: len(last_messages))
+    StatsCollector('clipbot_encoder', 'ffmpeg slot usage, see encoder.EncoderStats.', encoder.video_slots.stats)
+    StatsCollector('clipbot_audio_encoder', 'Audio ffmpeg slot usage, see encoder.EncoderStats.',
+                   encoder.audio_slots.stats)
+    StatsCollector('clipbot_format_cache', 'Format cache lookups, see formats.FormatCacheStats.', formats.stats)
+    if source_cache is not None:
+        StatsCollector('clipbot_source_cache', 'Source block cache, see sourcecache.SourceCacheStats.', source_cache.stats)
+    if segment_cache is not None:
+        StatsCollector('clipbot_segment_cache', 'Rendered segment reuse, see segments.SegmentCacheStats.',
+                       segment_cache.stats)
+    if api_scheduler is not None:
+        StatsCollector('clipbot_telegram_scheduler', 'Rate limited Bot API requests, see ratelimit.ApiSchedulerStats.',
+                       api_scheduler.stats)
+    if frames is not None:
+        StatsCollector('clipbot_frames', 'Frame previews, see frames.FrameStats.', frames.stats)
+        StatsCollector('clipbot_frame_encoder', 'Frame ffmpeg slot usage, see encoder.EncoderStats.',
+                       encoder.frame_slots.stats)
+        Gauge('clipbot_frames_cached', 'Frames kept in memory.', function=lambda: len(frames))
+        StatsCollector('clipbot_frame_prefetches', 'Frames rendered for inline queries, see debounce.DebounceStats.',
+                       frame_prefetches.stats)
+    StatsCollector('clipbot_message_renders', 'Debounced message renders, see debounce.DebounceStats.',
+                   message_renders.stats)
+    if speculator is not None:
+        StatsCollector('clipbot_speculation', 'Speculative work, see speculative.SpeculationStats.', speculator.stats)
+    Gauge('clipbot_ffmpeg_processes', 'Running ffmpeg and ffprobe processes.',
+          function=lambda: (encoder.video_slots.stats.running + encoder.audio_slots.stats.running
+                            + encoder.frame_slots.stats.running))
+    Gauge('clipbot_job_queue_depth', 'Render jobs waiting for a worker.', function=lambda: job_pool.queue.qsize())
+    Gauge('clipbot_jobs_running', 'Render jobs being processed.', function=lambda: job_pool.running)
+    Gauge('clipbot_audio_job_queue_depth', 'Audio jobs waiting for a worker.', function=lambda: audio_pool.queue.qsize())
+    Gauge('clipbot_audio_jobs_running', 'Audio jobs being processed.', function=lambda: audio_pool.running)
+    Gauge('clipbot_renders_in_flight', 'Distinct clips being rendered.', function=lambda: len(clip_jobs))
+    Gauge('clipbot_uploads_in_flight', 'Distinct clips being uploaded to the channel.', function=lambda: len(upload_jobs))
+    Gauge('clipbot_file_ids', 'Stored Telegram file_ids.', function=lambda: len(file_ids))
+
+
+def build_app(loop: asyncio.AbstractEventLoop, shard_index: Optional[int] = None, shards: int = 1) -> Dispatcher:
+    # Builds the bot, its caches, pools and metrics. Called once per process,
+    # by main.py or, with the shard's index, by supervisor.run_shard.
+    global bot, dispatcher, api_scheduler, file_ids, clip_jobs, upload_jobs, source_cache, segment_cache, \
+        speculator, message_renders, frame_prefetches, frames, job_pool, audio_pool, last_messages, metrics_port
+
+    # chats are sharded, the global limit is not, so every shard gets its part of it
+    api_scheduler = (ApiScheduler(rate=getattr(config, 'API_RATE', 30) / shards,
+                                  chat_rate=getattr(config, 'API_CHAT_RATE', 1),
+                                  chat_burst=getattr(config, 'API_CHAT_BURST', 5),
+                                  max_retries=getattr(config, 'API_MAX_RETRIES', 3))
+                     if getattr(config, 'API_RATE_LIMIT', True) else None)
+    bot = make_bot(loop, api_scheduler)
+    dispatcher = Dispatcher(bot)
+    register_handlers(dispatcher)
+
+    file_ids = FileIdStore(getattr(config, 'FILE_ID_DB', 'file_ids.sqlite3'),
+                           max_entries=getattr(config, 'FILE_ID_DB_SIZE', 100_000))
+    # a render that every waiter gave up on is removed from disk right away
+    clip_jobs = SingleFlight(discard=ClipFile.release)
+    upload_jobs = SingleFlight()
+    source_cache = (SourceCache(process_cache_dir(config.SOURCE_CACHE_DIR, shard_index, shards),
+                                max_bytes=getattr(config, 'SOURCE_CACHE_SIZE', 2 * 2 ** 30))
+                    if getattr(config, 'SOURCE_CACHE_DIR', None) else None)
+    segment_cache = (SegmentCache(process_cache_dir(config.SEGMENT_CACHE_DIR, shard_index, shards),
+                                  max_bytes=getattr(config, 'SEGMENT_CACHE_SIZE', 2 ** 30))
+                     if getattr(config, 'SEGMENT_CACHE_DIR', None) else None)
+    speculator = (Speculator(budget=getattr(config, 'SPECULATION_BUDGET', 4),
+                             ttl=getattr(config, 'SPECULATION_TTL', 120))
+                  if getattr(config, 'SPECULATIVE', False) else None)
+    message_renders = Debouncer(getattr(config, 'EDIT_DEBOUNCE', 0.5))
+    frame_prefetches = Debouncer(getattr(config, 'FRAME_DEBOUNCE', 1))
+    frames = (FrameCache(getattr(config, 'FRAME_CACHE_SIZE', 512), render_frame, upload_frame)
+              if getattr(config, 'FRAME_PREVIEWS', False) else None)
+    job_pool = WorkerPool(make_job_queue('clip-jobs'), render_job,
+                          workers=getattr(config, 'JOB_WORKERS', 2 * (os.cpu_count() or 1)),
+                          discard=ClipFile.release)
+    audio_pool = WorkerPool(make_job_queue('audio-jobs'), render_audio_job,
+                            workers=getattr(config, 'AUDIO_JOB_WORKERS', 4), discard=ClipFile.release)
+    last_messages = make_last_messages()
+
+    metrics_port = getattr(config, 'METRICS_PORT', None)
+    if metrics_port is not None and shard_index is not None:
+        # the supervisor itself does not serve metrics, shards use the ports after it
+        metrics_port += 1 + shard_index
+    register_metrics()
+    return dispatcher
+
+
+async def on_startup(dispatcher: Dispatcher):
+    global metrics_runner
+    if metrics_port is not None:
+        metrics_runner = await start_metrics_server(getattr(config, 'METRICS_HOST', '127.0.0.1'), metrics_port)
+    sweep_clip_dir()
+    if source_cache is not None:
+        await source_cache.start()
+    job_pool.start()
+    audio_pool.start()
+
+
+async def on_shutdown(dispatcher: Dispatcher):
+    timeout = getattr(config, 'SHUTDOWN_TIMEOUT', 60)
+    if not all(await asyncio.gather(job_pool.drain(timeout), audio_pool.drain(timeout))):
+        logger.warning('Shutting down with unfinished jobs')
+    await asyncio.gather(job_pool.stop(), audio_pool.stop())
+    if source_cache is not None:
+        await source_cache.stop()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    if isinstance(last_messages, MessageStore):
+        last_messages.close()
+
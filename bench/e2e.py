@@ -0,0 +1,285 @@
+# Replays Telegram updates against the bot with YouTube and the Bot API
+# replaced by local fakes, and reports latency, throughput and resource use.
+#
+#     python -m bench.e2e video.mp4 [more.mp4 ...] --requests 40 --concurrency 8 \
+#         --workload message,edit,inline,callback --set SMART_CUT=False
+#
+# Every media file is served as a separate "video" over a local HTTP server
+# with range support, and youtube_dl extraction returns it as one mp4 and one
+# audio-only m4a format. Settings that would normally come from config.py are
+# built here; --set NAME=VALUE overrides them. Nothing goes to the network.
+import argparse
+import ast
+import asyncio
+import itertools
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import types
+from collections import Counter, defaultdict
+from time import perf_counter
+from typing import Dict, List, Tuple
+
+from aiohttp import web
+
+TOKEN = '123456:bench'
+CHANNEL_ID = -1000
+WORKLOADS = ('message', 'edit', 'retype', 'inline', 'callback', 'batch')
+BATCH_SIZE = 3
+CALLBACK_ACTIONS = ('preview', 'video', 'audio')
+
+
+class FakeServers:
+    # The fakes run on their own loop in a thread, so that serving media and
+    # swallowing uploads does not compete with the bot for its event loop.
+
+    def __init__(self, media: Dict[str, str]):
+        self.media = media
+        self.calls: Counter = Counter()
+        self.uploaded_bytes = 0
+        self._message_ids = itertools.count(1)
+        self._loop = asyncio.new_event_loop()
+        self._runner = None
+        self.base_url = None
+
+    def start(self) -> None:
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+
+    def stop(self) -> None:
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    async def _start(self) -> None:
+        app = web.Application(client_max_size=2 ** 30)
+        app.router.add_get('/media/{youtube_id}', self._media)
+        app.router.add_route('*', '/bot{token}/{method}', self._api)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.base_url = f'http://{host}:{port}'
+
+    async def _media(self, request: web.Request) -> web.StreamResponse:
+        return web.FileResponse(self.media[request.match_info['youtube_id']])
+
+    def _message(self, chat_id, **media) -> dict:
+        return {'message_id': next(self._message_ids), 'date': 0,
+                'chat': {'id': int(chat_id), 'type': 'private'}, **media}
+
+    async def _api(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.calls[method] += 1
+        if request.content_type.startswith('multipart/'):
+            fields = {}
+            reader = await request.multipart()
+            while (part := await reader.next()) is not None:
+                data = await part.read()
+                if part.filename is None:
+                    fields[part.name] = data.decode()
+                else:
+                    self.uploaded_bytes += len(data)
+        else:
+            fields = await request.post()
+
+        file_id = f'file-{self.calls[method]}'
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench'}
+        elif method == 'sendVideo':
+            result = self._message(fields.get('chat_id', CHANNEL_ID),
+                                   video={'file_id': file_id, 'file_unique_id': file_id,
+                                          'width': 640, 'height': 360, 'duration': 10})
+        elif method == 'sendAudio':
+            result = self._message(fields.get('chat_id', CHANNEL_ID),
+                                   audio={'file_id': file_id, 'file_unique_id': file_id, 'duration': 10})
+        elif method == 'sendPhoto':
+            result = self._message(fields.get('chat_id', CHANNEL_ID),
+                                   photo=[{'file_id': file_id, 'file_unique_id': file_id, 'width': 640, 'height': 360}])
+        elif method == 'sendMediaGroup':
+            result = [self._message(fields['chat_id'],
+                                    video={'file_id': f'{file_id}-{i}', 'file_unique_id': f'{file_id}-{i}',
+                                           'width': 640, 'height': 360, 'duration': 10})
+                      for i, _ in enumerate(json.loads(fields['media']))]
+        elif method == 'editMessageMedia' and 'chat_id' in fields:
+            result = self._message(fields['chat_id'],
+                                   video={'file_id': file_id, 'file_unique_id': file_id,
+                                          'width': 640, 'height': 360, 'duration': 10})
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+
+def make_config(api_url: str, clip_dir: str, overrides: List[str]) -> types.ModuleType:
+    config = types.ModuleType('config')
+    config.TOKEN = TOKEN
+    config.BOT_CHANNEL_ID = CHANNEL_ID
+    config.TELEGRAM_API_URL = api_url
+    config.CLIP_DIR = clip_dir
+    config.FILE_ID_DB = ':memory:'
+    for override in overrides:
+        name, value = override.split('=', 1)
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+        setattr(config, name, value)
+    return config
+
+
+def fake_extract_info(media_url: str):
+    def extract(youtube_url: str) -> dict:
+        youtube_id = youtube_url.rsplit('/', 1)[-1]
+        # the audio-only format is the same file, ffmpeg only reads its audio
+        return {'id': youtube_id, 'formats': [{
+            'format_id': '140', 'ext': 'm4a', 'acodec': 'mp4a.40.2', 'vcodec': 'none',
+            'abr': 128, 'tbr': 128, 'url': f'{media_url}/{youtube_id}?itag=140',
+        }, {
+            'format_id': '18', 'ext': 'mp4', 'acodec': 'mp4a.40.2', 'vcodec': 'avc1.42001E',
+            'height': 360, 'tbr': 500, 'url': f'{media_url}/{youtube_id}?itag=18',
+        }]}
+    return extract
+
+
+def user(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+
+
+def message_update(update_id: int, message_id: int, user_id: int, text: str, edited: bool = False) -> dict:
+    message = {'message_id': message_id, 'date': 0, 'text': text,
+               'chat': {'id': user_id, 'type': 'private'}, 'from': user(user_id)}
+    return {'update_id': update_id, 'edited_message' if edited else 'message': message}
+
+
+def make_workload(kind: str, i: int, youtube_id: str, start: int, end: int) -> Tuple[List[dict], List[dict]]:
+    # (setup updates that are not timed, the timed updates, replayed at once)
+    user_id = 1000 + i
+    # a bare number as the end is a length
+    text = f'https://youtu.be/{youtube_id} {start} {end - start}'
+    if kind == 'message':
+        return [], [message_update(i, 1, user_id, text)]
+    elif kind == 'edit':
+        # the original message renders first, the edit moves its end
+        return ([message_update(i, 1, user_id, text)],
+                [message_update(i, 1, user_id, f'https://youtu.be/{youtube_id} {start} {end - start + 5}', edited=True)])
+    elif kind == 'retype':
+        # the end is fixed three times in a row, only the last edit should render
+        return ([message_update(i, 1, user_id, text)],
+                [message_update(i, 1, user_id, f'https://youtu.be/{youtube_id} {start} {end - start + n}', edited=True)
+                 for n in (1, 2, 3)])
+    elif kind == 'batch':
+        # several ranges of the same video in one message
+        lines = [f'https://youtu.be/{youtube_id} {start + 3 * n} {end - start}' for n in range(BATCH_SIZE)]
+        return [], [message_update(i, 1, user_id, '\n'.join(lines))]
+    elif kind == 'inline':
+        return [], [{'update_id': i, 'inline_query': {'id': str(i), 'from': user(user_id), 'query': text, 'offset': ''}}]
+    elif kind == 'callback':
+        action = CALLBACK_ACTIONS[i % len(CALLBACK_ACTIONS)]
+        return [], [{'update_id': i, 'callback_query': {
+            'id': str(i), 'from': user(user_id), 'chat_instance': str(i), 'inline_message_id': f'inline-{i}',
+            'data': f'{user_id} {youtube_id} {start} {end} {action}',
+        }}]
+    else:
+        raise ValueError(kind)
+
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(p / 100 * len(ordered)), len(ordered) - 1)]
+
+
+def cpu_seconds() -> Tuple[float, float]:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime
+
+
+async def replay(app, args, youtube_ids: List[str]) -> None:
+    from aiogram import types as tg
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    kinds = itertools.cycle(args.workload.split(','))
+
+    async def run(i: int, kind: str) -> None:
+        youtube_id = youtube_ids[i % len(youtube_ids)]
+        # distinct ranges, so that caches only help where --repeat asks for it
+        start = (i // args.repeat * 7) % max(args.video_length - args.length - 5, 1)
+        setup, updates = make_workload(kind, i, youtube_id, start, start + args.length)
+        async with semaphore:
+            for data in setup:
+                await app.dispatcher.process_update(tg.Update(**data))
+            started_at = perf_counter()
+            await asyncio.gather(*(app.dispatcher.process_update(tg.Update(**data)) for data in updates))
+            latencies[kind].append(perf_counter() - started_at)
+
+    own_before, children_before = cpu_seconds()
+    started_at = perf_counter()
+    await asyncio.gather(*(run(i, next(kinds)) for i in range(args.requests)))
+    wall = perf_counter() - started_at
+    own_after, children_after = cpu_seconds()
+
+    rendered = app.encoder.video_slots.stats.finished + app.encoder.audio_slots.stats.finished
+    print(f'{args.requests} updates in {wall:.2f}s, {args.requests / wall:.2f} updates/s, '
+          f'concurrency {args.concurrency}')
+    for kind, values in latencies.items():
+        print(f'{kind:>10}: n={len(values):<4} p50 {percentile(values, 50):7.3f}s  '
+              f'p95 {percentile(values, 95):7.3f}s  p99 {percentile(values, 99):7.3f}s')
+
+    clips = sum(len(values) * (BATCH_SIZE if kind == 'batch' else 1)
+                for kind, values in latencies.items() if kind != 'inline') or 1
+    print(f'cpu per clip: bot {(own_after - own_before) / clips:.3f}s, '
+          f'ffmpeg {(children_after - children_before) / clips:.3f}s ({rendered} ffmpeg runs)')
+    print(f'peak rss: bot {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB, '
+          f'largest ffmpeg {resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024:.1f} MiB')
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('media', nargs='+', help='local video files to serve as YouTube videos')
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--workload', default=','.join(WORKLOADS),
+                        help=f'comma separated mix of {", ".join(WORKLOADS)}, replayed round-robin')
+    parser.add_argument('--length', type=int, default=10, help='clip length in seconds')
+    parser.add_argument('--video-length', type=int, default=60, help='shortest media file length in seconds')
+    parser.add_argument('--repeat', type=int, default=1, help='how many requests share each range')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='override a config.py setting')
+    return parser.parse_args()
+
+
+def run() -> None:
+    args = parse_args()
+    youtube_ids = [f'bench{i:06d}' for i in range(len(args.media))]
+    servers = FakeServers(dict(zip(youtube_ids, map(os.path.abspath, args.media))))
+    servers.start()
+
+    with tempfile.TemporaryDirectory() as clip_dir:
+        sys.modules['config'] = make_config(servers.base_url, clip_dir, args.set)
+        import app
+        import extractor
+        from aiogram import Bot, Dispatcher
+
+        extractor._extract_info = fake_extract_info(f'{servers.base_url}/media')
+        loop = asyncio.get_event_loop()
+        dispatcher = app.build_app(loop)
+        Bot.set_current(dispatcher.bot)
+        Dispatcher.set_current(dispatcher)
+
+        loop.run_until_complete(app.on_startup(dispatcher))
+        try:
+            loop.run_until_complete(replay(app, args, youtube_ids))
+        finally:
+            loop.run_until_complete(app.on_shutdown(dispatcher))
+            loop.run_until_complete(dispatcher.bot.session.close())
+            servers.stop()
+
+    print(f'bot api calls: {dict(servers.calls)}, uploaded {servers.uploaded_bytes / 2 ** 20:.1f} MiB')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,139 @@
+# Compares request parsing against the implementation it replaced.
+#
+#     python -m bench.parse <baseline revision> [repeat]
+#
+# The corpus mixes complete requests, every prefix of a few requests as they
+# are typed into an inline query, and messages that are not requests at all.
+# Both implementations must agree on every input before anything is timed.
+#
+# The baseline is parse.py at the given revision, e.g. the commit before the
+# compiled grammar, read with `git show`, so the benchmark runs in a clone.
+import os
+import subprocess
+import sys
+from time import perf_counter
+from types import ModuleType
+from typing import Callable, List
+
+import parse
+
+
+def load_baseline(revision: str) -> ModuleType:
+    shown = subprocess.run(['git', 'show', f'{revision}:parse.py'], capture_output=True, text=True,
+                           cwd=os.path.dirname(os.path.abspath(parse.__file__)))
+    if shown.returncode:
+        sys.exit(f'cannot read parse.py at {revision}: {shown.stderr.strip()}')
+    source = shown.stdout
+    module = ModuleType('parse_baseline')
+    # dataclasses look the module up while the class is being built
+    sys.modules[module.__name__] = module
+    exec(compile(source, f'{revision}:parse.py', 'exec'), module.__dict__)
+    return module
+
+
+REQUESTS = [
+    'https://youtu.be/C0DPdy98e4c?t=1h20m18s 1h20m40s',
+    'https://youtu.be/C0DPdy98e4c?t=1h20m18s ..40s',
+    'https://youtu.be/C0DPdy98e4c?t=1h20m18s 10',
+    'https://youtu.be/C0DPdy98e4c 1h20m18s 1h20m40s',
+    'https://youtu.be/C0DPdy98e4c 1:20:18 1:20:40',
+    'https://www.youtube.com/watch?v=C0DPdy98e4c&t=4818 +1m',
+    'https://youtu.be/C0DPdy98e4c full',
+    'https://youtu.be/C0DPdy98e4c 20 10',
+    'https://youtu.be/C0DPdy98e4c 0 20m',
+]
+
+URLS = [
+    f'{scheme}{host}{path}'
+    for scheme in ('https://', 'http://', '')
+    for host, paths in [
+        ('www.youtube.com', ['/watch?v=Bx51eegLTY8', '/watch?v=Bx51eegLTY8&t=2m33s', '/watch?feature=share&v=Bx51eegLTY8',
+                             '/feed/subscriptions']),
+        ('youtube.com', ['/watch?v=Bx51eegLTY8', '/watch?v=Bx51eegLTY8&t=2m33s']),
+        ('youtu.be', ['/Bx51eegLTY8', '/Bx51eegLTY8?t=2m33s', '/Bx51eegLTY8?si=abc&t=95']),
+    ]
+    for path in paths
+]
+
+NOT_REQUESTS = [
+    'check this out https://example.com/watch?v=C0DPdy98e4c',
+    'https://youtube.com/feed/subscriptions',
+    'ok',
+    'https://youtu.be/C0DPdy98e4c what a great song',
+]
+
+
+def keystrokes(s: str) -> List[str]:
+    return [s[:i] for i in range(1, len(s) + 1)]
+
+
+def baseline_inline_query(parse_baseline: ModuleType) -> Callable:
+    def match_inline_query(s: str):
+        return parse_baseline.first_some([
+            parse_baseline.match_request(s),
+            parse_baseline.match_request(s + ' 10'),
+            parse_baseline.match_request(s + ' 0 10'),
+        ])
+    return match_inline_query
+
+
+def outcome(f: Callable, s: str):
+    try:
+        result = f(s)
+    except (ValueError, TypeError) as e:
+        return type(e).__name__, str(e)
+    if hasattr(result, 'youtube_id'):
+        return result.youtube_id, result.start, result.end
+    # furl hands back its own multidict
+    return None if result is None else dict(result)
+
+
+def timed(f: Callable, corpus: List[str], repeat: int) -> float:
+    started_at = perf_counter()
+    for _ in range(repeat):
+        for s in corpus:
+            try:
+                f(s)
+            except (ValueError, TypeError):
+                pass
+    return (perf_counter() - started_at) / (repeat * len(corpus)) * 1e6
+
+
+def fixed_in_current(result) -> bool:
+    # the furl based parser crashed on a bare ?t and accepted a bare ?v or an
+    # empty path as the video id
+    return isinstance(result, tuple) and result[0] in ('TypeError', '', None)
+
+
+def compare(name: str, baseline: Callable, current: Callable, corpus: List[str], repeat: int) -> None:
+    for s in corpus:
+        expected = outcome(baseline, s)
+        if not fixed_in_current(expected):
+            assert expected == outcome(current, s), s
+
+    before = timed(baseline, corpus, repeat)
+    after = timed(current, corpus, repeat)
+    print(f'{name:>14}: {len(corpus):5} inputs  baseline {before:7.2f}us  current {after:7.2f}us  '
+          f'x{before / after:.1f}')
+
+
+def main(revision: str, repeat: int) -> None:
+    parse_baseline = load_baseline(revision)
+    messages = REQUESTS + NOT_REQUESTS
+    typed = [prefix for s in REQUESTS for prefix in keystrokes(s)]
+
+    compare('youtube url', parse_baseline.youtube_url_as_dict, parse.youtube_url_as_dict, URLS, repeat)
+    compare('match_request', parse_baseline.match_request, parse.match_request, messages, repeat)
+    compare('inline query', baseline_inline_query(parse_baseline), parse.match_inline_query, typed, repeat)
+
+    started_at = perf_counter()
+    for _ in range(repeat):
+        parse.match_requests(messages)
+    batch = (perf_counter() - started_at) / (repeat * len(messages)) * 1e6
+    print(f'{"match_requests":>14}: {len(messages):5} inputs  current {batch:7.2f}us per line')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit('usage: python -m bench.parse <baseline revision> [repeat]')
+    main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 200)
@@ -0,0 +1,63 @@
+# Compares encode time and CPU seconds of the clip cutting strategies, and
+# checks that every cut has its audio in sync and decodes without errors.
+#
+#     python -m bench.smart_cut video.mp4 10:25 30:90 100:160
+#
+# Each range is start:end in seconds. Run from the repository root with a
+# config.py in place, since the cutting code reads its settings from it.
+import asyncio
+import os
+import resource
+import sys
+from time import perf_counter
+
+from clip import download_clip_single_pass, download_clip_smart, download_clip_two_pass
+from profiles import choose_profile
+from smartcut import check_av_sync, check_decodes
+
+STRATEGIES = {
+    'smart': lambda url, start, end, profile: download_clip_smart(url, start, end, profile),
+    'single_pass': lambda url, start, end, profile: download_clip_single_pass(url, start, end, profile),
+    'two_pass': lambda url, start, end, profile: download_clip_two_pass(url, start, end, 'mp4', profile),
+}
+
+
+def children_cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+async def measure(name: str, url: str, start: int, end: int) -> None:
+    cpu_before = children_cpu_seconds()
+    wall_before = perf_counter()
+    clip = await STRATEGIES[name](url, start, end, choose_profile('clip', end - start))
+    wall = perf_counter() - wall_before
+    cpu = children_cpu_seconds() - cpu_before
+
+    try:
+        await check_av_sync(clip.path, end - start)
+        sync = 'ok'
+    except Exception as e:
+        sync = str(e)
+    try:
+        await check_decodes(clip.path)
+        decode = 'ok'
+    except Exception as e:
+        decode = str(e)
+    size = os.path.getsize(clip.path)
+    os.remove(clip.path)
+
+    print(f'{name:>12} {start:>6}-{end:<6} wall {wall:7.2f}s  cpu {cpu:7.2f}s  '
+          f'{size / 2 ** 20:7.2f} MiB  sync: {sync}  decode: {decode}')
+
+
+async def main(url: str, ranges) -> None:
+    for start, end in ranges:
+        for name in STRATEGIES:
+            await measure(name, url, start, end)
+
+
+if __name__ == '__main__':
+    path, *raw_ranges = sys.argv[1:]
+    asyncio.run(main(os.path.abspath(path),
+                     [tuple(map(int, r.split(':'))) for r in raw_ranges]))
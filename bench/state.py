@@ -0,0 +1,57 @@
+# Compares the memory and speed of the message store with the TTLCache it
+# replaced.
+#
+#     python -m bench.state [entries]
+#
+# Keys look like group chats: a few thousand chat ids with growing message
+# ids. Memory is what tracemalloc sees allocated after filling each store.
+import random
+import sys
+import tracemalloc
+from time import perf_counter
+from typing import Callable, List, MutableMapping, Tuple
+
+from cachetools import TTLCache
+
+from state import HEADER, MAX_LOAD, SLOT, MessageStore
+
+CHATS = 5000
+
+
+def make_keys(entries: int) -> List[Tuple[int, int]]:
+    chat_ids = [-1001000000000 - i for i in range(CHATS)]
+    return [(chat_ids[i % CHATS], 1 + i // CHATS) for i in range(entries)]
+
+
+def measure(name: str, make_store: Callable[[], MutableMapping], keys: List[Tuple[int, int]]) -> None:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    store = make_store()
+    started_at = perf_counter()
+    for message_id, key in enumerate(keys, 1):
+        store[key] = message_id
+    put = (perf_counter() - started_at) / len(keys) * 1e6
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    sample = random.Random(0).sample(keys, min(len(keys), 100_000))
+    started_at = perf_counter()
+    for key in sample:
+        store[key]
+    get = (perf_counter() - started_at) / len(sample) * 1e6
+
+    print(f'{name:>12}: {len(store):9} entries  {used / 2 ** 20:8.1f} MiB  '
+          f'{used / len(store):6.1f} B/entry  {used / len(store) * 1e6 / 2 ** 20:6.1f} MiB per million  '
+          f'put {put:5.2f}us  get {get:5.2f}us')
+
+
+def main(entries: int) -> None:
+    keys = make_keys(entries)
+    measure('TTLCache', lambda: TTLCache(maxsize=entries, ttl=86400), keys)
+    # sized so that three of the four generations hold every key
+    table_bytes = HEADER.size + int(entries / 3 / MAX_LOAD + 1) * SLOT.size
+    measure('MessageStore', lambda: MessageStore(4 * table_bytes), keys)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
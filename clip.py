@@ -0,0 +1,326 @@
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from dataclasses import dataclass
+from multiprocessing import current_process
+from typing import Iterator, List, Literal, Tuple
+from uuid import uuid4
+
+from aiogram.types import InputFile
+from ffmpy import FFExecutableNotFoundError, FFmpeg, FFRuntimeError
+
+import config
+from encoder import EncoderBusy, EncoderSlots, audio_slots, frame_slots, run_ffmpeg, video_slots
+from log import make_logger
+from profiles import AUDIO_COPY_EXTS, EncodingProfile, audio_options, video_options
+from segments import Segment
+from smartcut import SmartCutError, gather_or_cancel, smart_cut
+
+SMART_CUT: bool = getattr(config, 'SMART_CUT', True)
+SINGLE_PASS: bool = getattr(config, 'SINGLE_PASS', True)
+CLIP_DIR: str = getattr(config, 'CLIP_DIR', tempfile.gettempdir())
+
+logger = make_logger(__name__)
+
+
+@dataclass
+class ClipFile:
+    # A rendered clip on local disk, shared by everyone waiting for the same
+    # render. The file is removed once the last user has released it, or by
+    # release() if nobody is left to use it.
+    path: str
+    users: int = 0
+
+    @contextmanager
+    def open(self) -> Iterator[InputFile]:
+        self.users += 1
+        try:
+            # aiohttp reads the file in chunks while uploading
+            with open(self.path, 'rb') as f:
+                yield InputFile(f, filename=os.path.basename(self.path))
+        finally:
+            self.users -= 1
+            self.release()
+
+    def release(self) -> None:
+        if not self.users:
+            remove_quietly(self.path)
+
+
+def remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def output_ext(type_: Literal['video', 'audio']) -> str:
+    if type_ == 'video':
+        return 'mp4'
+    elif type_ == 'audio':
+        return 'mp3'
+    else:
+        raise ValueError(type_)
+
+
+def clip_prefix() -> str:
+    # shards share CLIP_DIR, each one only sweeps its own files
+    return f'clip-{current_process().name}-'
+
+
+def clip_path(ext: str) -> str:
+    return os.path.join(CLIP_DIR, f'{clip_prefix()}{uuid4().hex}.{ext}')
+
+
+def make_work_dir() -> str:
+    return tempfile.mkdtemp(prefix=clip_prefix(), dir=CLIP_DIR)
+
+
+def sweep_clip_dir() -> None:
+    # clips and work directories left behind by a previous run of this process
+    for entry in os.scandir(CLIP_DIR):
+        if not entry.name.startswith(clip_prefix()):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            remove_quietly(entry.path)
+
+
+def codec_options(type_: Literal['video', 'audio'], profile: EncodingProfile, duration: int) -> List[str]:
+    if type_ == 'video':
+        return [*video_options(profile, duration), '-c:a', 'aac', *audio_options(profile)]
+    else:
+        return audio_options(profile)
+
+
+def container_options(type_: Literal['video', 'audio']) -> List[str]:
+    return ['-movflags', '+faststart'] if type_ == 'video' else []
+
+
+def encode_options(type_: Literal['video', 'audio'], profile: EncodingProfile, duration: int) -> List[str]:
+    return [*codec_options(type_, profile, duration), *container_options(type_)]
+
+
+async def download_clip_single_pass(url: str, start: int, end: int, profile: EncodingProfile,
+                                    type_: Literal['video', 'audio'] = 'video',
+                                    slots: EncoderSlots = video_slots) -> ClipFile:
+    out_file_path = clip_path(output_ext(type_))
+
+    ff = FFmpeg(
+        inputs={url: ['-ss', str(start)]},
+        outputs={out_file_path: ['-t', str(end - start),
+                                 *encode_options(type_, profile, end - start)]},
+        global_options='-v warning'
+    )
+    logger.info(ff.cmd)
+    try:
+        await run_ffmpeg(ff, slots=slots)
+        if not os.path.getsize(out_file_path):
+            raise FFRuntimeError(ff.cmd, 0, None, None)
+    except BaseException:
+        remove_quietly(out_file_path)
+        raise
+
+    return ClipFile(out_file_path)
+
+
+async def download_clip_smart(url: str, start: int, end: int, profile: EncodingProfile) -> ClipFile:
+    out_file_path = clip_path('mp4')
+    work_dir = make_work_dir()
+    try:
+        await smart_cut(url, start, end, profile, out_file_path, work_dir)
+    except BaseException:
+        remove_quietly(out_file_path)
+        raise
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return ClipFile(out_file_path)
+
+
+async def download_clip_two_pass(url: str, start: int, end: int, source_ext: str, profile: EncodingProfile,
+                                 type_: Literal['video', 'audio'] = 'video',
+                                 slots: EncoderSlots = video_slots) -> ClipFile:
+    temp_file_path = clip_path(f'temp.{source_ext}')
+    out_file_path = clip_path(output_ext(type_))
+
+    try:
+        ff = FFmpeg(
+            inputs={url: ['-ss', str(start)]},
+            outputs={temp_file_path: ['-t', str(end - start),
+                                      '-c', 'copy']},
+            global_options='-v warning'
+        )
+        logger.info(ff.cmd)
+        await run_ffmpeg(ff, stage='ffmpeg_cut', slots=slots)
+
+        ff = FFmpeg(
+            inputs={temp_file_path: ['-seek_timestamp',
+                                     '1', '-ss', '0']},
+            outputs={out_file_path: encode_options(type_, profile, end - start)},
+            global_options='-v warning'
+        )
+        logger.info(ff.cmd)
+        await run_ffmpeg(ff, slots=slots)
+    except BaseException:
+        remove_quietly(out_file_path)
+        raise
+    finally:
+        remove_quietly(temp_file_path)
+
+    return ClipFile(out_file_path)
+
+
+async def download_clip_from_segment(url: str, segment: Segment, start: int, end: int, profile: EncodingProfile,
+                                     type_: Literal['video', 'audio'] = 'video') -> ClipFile:
+    ext = output_ext(type_)
+    out_file_path = clip_path(ext)
+    work_dir = make_work_dir()
+
+    def part(name: str) -> str:
+        return os.path.join(work_dir, name)
+
+    try:
+        # the cache may drop the segment while it is being read
+        try:
+            os.link(segment.path, part(f'base.{ext}'))
+        except OSError:
+            shutil.copyfile(segment.path, part(f'base.{ext}'))
+
+        if end < segment.end:
+            ff = FFmpeg(
+                inputs={part(f'base.{ext}'): None},
+                outputs={out_file_path: ['-t', str(end - start), '-c', 'copy', *container_options(type_)]},
+                global_options='-v warning'
+            )
+        else:
+            # A video is joined through MPEG-TS like in smartcut, the delta is a
+            # separate encode whose SPS and PPS differ from the segment's, and an
+            # mp4 keeps only the first piece's avcC.
+            piece_ext, piece_options = ('ts', ['-f', 'mpegts']) if type_ == 'video' else (ext, [])
+            jobs = [(FFmpeg(
+                inputs={url: ['-ss', str(segment.end)]},
+                outputs={part(f'delta.{piece_ext}'): ['-t', str(end - segment.end),
+                                                      *codec_options(type_, profile, end - start),
+                                                      *piece_options]},
+                global_options='-v warning'
+            ), 'ffmpeg_encode')]
+            if type_ == 'video':
+                jobs.append((FFmpeg(
+                    inputs={part(f'base.{ext}'): None},
+                    outputs={part('base.ts'): ['-c', 'copy', '-bsf:v', 'h264_mp4toannexb', *piece_options]},
+                    global_options='-v warning'
+                ), 'ffmpeg_cut'))
+            for ff, _ in jobs:
+                logger.info(ff.cmd)
+            await gather_or_cancel([run_ffmpeg(ff, stage=stage) for ff, stage in jobs])
+
+            with open(part('segments.txt'), 'w') as f:
+                f.write(f"file '{part(f'base.{piece_ext}')}'\n")
+                f.write(f"file '{part(f'delta.{piece_ext}')}'\n")
+
+            ff = FFmpeg(
+                inputs={part('segments.txt'): ['-f', 'concat', '-safe', '0']},
+                outputs={out_file_path: ['-c', 'copy', *container_options(type_)]},
+                global_options='-v warning'
+            )
+        logger.info(ff.cmd)
+        await run_ffmpeg(ff, stage='ffmpeg_cut')
+        if not os.path.getsize(out_file_path):
+            raise FFRuntimeError(ff.cmd, 0, None, None)
+    except BaseException:
+        remove_quietly(out_file_path)
+        raise
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return ClipFile(out_file_path)
+
+
+async def download_clip(url: Tuple[str, str], start: int, end: int, profile: EncodingProfile,
+                        type_: Literal['video', 'audio'] = 'video') -> ClipFile:
+    source_ext, url = url
+
+    if SMART_CUT and type_ == 'video':
+        try:
+            return await download_clip_smart(url, start, end, profile)
+        except (SmartCutError, EncoderBusy, FFRuntimeError, FFExecutableNotFoundError) as e:
+            # a single pass needs one slot instead of the smart cut's four
+            logger.warning('Smart cut failed, re-encoding the whole clip: %s', e)
+
+    if SINGLE_PASS:
+        try:
+            return await download_clip_single_pass(url, start, end, profile, type_)
+        except FFRuntimeError as e:
+            logger.warning('Single-pass cut failed, falling back to two passes: %s', e)
+
+    return await download_clip_two_pass(url, start, end, source_ext, profile, type_)
+
+
+async def download_audio_copy(url: str, start: int, end: int) -> ClipFile:
+    out_file_path = clip_path('m4a')
+
+    ff = FFmpeg(
+        inputs={url: ['-ss', str(start)]},
+        outputs={out_file_path: ['-t', str(end - start), '-vn', '-c:a', 'copy',
+                                 '-movflags', '+faststart']},
+        global_options='-v warning'
+    )
+    logger.info(ff.cmd)
+    try:
+        await run_ffmpeg(ff, stage='ffmpeg_cut', slots=audio_slots)
+        if not os.path.getsize(out_file_path):
+            raise FFRuntimeError(ff.cmd, 0, None, None)
+    except BaseException:
+        remove_quietly(out_file_path)
+        raise
+
+    return ClipFile(out_file_path)
+
+
+async def download_audio_clip(url: Tuple[str, str], start: int, end: int, profile: EncodingProfile) -> ClipFile:
+    source_ext, url = url
+
+    if source_ext in AUDIO_COPY_EXTS:
+        try:
+            return await download_audio_copy(url, start, end)
+        except FFRuntimeError as e:
+            logger.warning('Audio stream copy failed, encoding mp3: %s', e)
+
+    if SINGLE_PASS:
+        try:
+            return await download_clip_single_pass(url, start, end, profile, 'audio', slots=audio_slots)
+        except FFRuntimeError as e:
+            logger.warning('Single-pass cut failed, falling back to two passes: %s', e)
+
+    return await download_clip_two_pass(url, start, end, source_ext, profile, 'audio', slots=audio_slots)
+
+
+async def extract_frame(url: str, second: int, max_height: int, thumb_size: int = 320) -> Tuple[bytes, bytes]:
+    work_dir = make_work_dir()
+    photo_path = os.path.join(work_dir, 'photo.jpg')
+    thumb_path = os.path.join(work_dir, 'thumb.jpg')
+
+    # one input seek and one decoded frame feed both images
+    ff = FFmpeg(
+        inputs={url: ['-ss', str(second)]},
+        outputs={
+            photo_path: ['-frames:v', '1', '-update', '1', '-an', '-q:v', '3',
+                         '-vf', f"scale=-2:'min({max_height},ih)'"],
+            thumb_path: ['-frames:v', '1', '-update', '1', '-an', '-q:v', '5',
+                         '-vf', f'scale={thumb_size}:{thumb_size}:force_original_aspect_ratio=decrease'],
+        },
+        global_options='-v warning'
+    )
+    logger.info(ff.cmd)
+    try:
+        await run_ffmpeg(ff, stage='ffmpeg_frame', slots=frame_slots)
+        with open(photo_path, 'rb') as photo, open(thumb_path, 'rb') as thumb:
+            return photo.read(), thumb.read()
+    except FileNotFoundError:
+        # seeking past the last frame succeeds without writing anything
+        raise FFRuntimeError(ff.cmd, 0, None, None)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
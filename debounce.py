@@ -0,0 +1,80 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+
+
+@dataclass
+class DebounceStats:
+    started: int = 0
+    superseded: int = 0
+    finished: int = 0
+
+
+class Debouncer:
+    # Runs only the newest job for each key, e.g. each edited message. A job
+    # waits `delay` seconds before starting, and a newer job for the same key
+    # cancels it, whether it is still waiting or already running. The newer
+    # job starts once the cancelled one has ended, see finish().
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.stats = DebounceStats()
+        self._tasks: Dict[Hashable, asyncio.Future] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._tasks
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    async def run(self, key: Hashable, make_job: Callable[[], Awaitable], delay: Optional[float] = None) -> bool:
+        # False if a newer job for the key replaced this one
+        previous = self._tasks.get(key)
+        if previous is not None and not previous.done():
+            previous.cancel()
+            self.stats.superseded += 1
+
+        task = asyncio.ensure_future(self._delayed(make_job, self.delay if delay is None else delay, previous))
+        self._tasks[key] = task
+        self.stats.started += 1
+        try:
+            await asyncio.wait([task])
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            if self._tasks.get(key) is task:
+                del self._tasks[key]
+
+        if task.cancelled():
+            return False
+        task.result()
+        self.stats.finished += 1
+        return True
+
+    @staticmethod
+    async def _delayed(make_job: Callable[[], Awaitable], delay: float,
+                       previous: Optional[asyncio.Future]) -> None:
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if previous is not None:
+            await asyncio.wait([previous])
+        await make_job()
+
+
+async def finish(aw: Awaitable):
+    # Runs the part of a job that must not stop halfway, e.g. a request that
+    # may already have reached Telegram and whose message has to be recorded.
+    # A cancel waits for it and is raised once it has finished.
+    task = asyncio.ensure_future(aw)
+    cancelled = False
+    while not task.done():
+        try:
+            await asyncio.wait([task])
+        except asyncio.CancelledError:
+            cancelled = True
+    if cancelled:
+        if not task.cancelled():
+            task.exception()
+        raise asyncio.CancelledError
+    return task.result()
@@ -0,0 +1,132 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from subprocess import DEVNULL, PIPE
+from time import monotonic
+from typing import Optional, Tuple
+
+from ffmpy import FFExecutableNotFoundError, FFmpeg, FFRuntimeError
+
+import config
+from metrics import STAGE_SECONDS
+
+ENCODER_WORKERS: int = getattr(config, 'ENCODER_WORKERS', os.cpu_count() or 1)
+ENCODER_QUEUE_SIZE: int = getattr(config, 'ENCODER_QUEUE_SIZE', 4 * ENCODER_WORKERS)
+AUDIO_ENCODER_WORKERS: int = getattr(config, 'AUDIO_ENCODER_WORKERS', 2)
+FRAME_WORKERS: int = getattr(config, 'FRAME_WORKERS', 2)
+
+
+class EncoderBusy(Exception):
+    pass
+
+
+# Set while running work that a job pool has accepted. Its ffmpeg runs wait
+# for a slot but are never rejected, the pool already bounds how many run.
+_accepted: ContextVar[bool] = ContextVar('accepted', default=False)
+
+
+@contextmanager
+def accepted():
+    # tasks started inside, e.g. the concurrent pieces of a smart cut, inherit it
+    token = _accepted.set(True)
+    try:
+        yield
+    finally:
+        _accepted.reset(token)
+
+
+@dataclass
+class EncoderStats:
+    queued: int = 0
+    running: int = 0
+    finished: int = 0
+    failed: int = 0
+    rejected: int = 0
+    wait_seconds: float = 0.0
+    run_seconds: float = 0.0
+
+
+class EncoderSlots:
+    # A bounded number of concurrent ffmpeg processes with a bounded wait list.
+
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.stats = EncoderStats()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @asynccontextmanager
+    async def slot(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers)
+
+        stats = self.stats
+        if stats.queued >= self.queue_size and not _accepted.get():
+            stats.rejected += 1
+            raise EncoderBusy('Too many clips are being processed right now, try again later.')
+
+        stats.queued += 1
+        queued_at = monotonic()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            stats.queued -= 1
+        started_at = monotonic()
+        stats.wait_seconds += started_at - queued_at
+
+        stats.running += 1
+        try:
+            yield
+        except BaseException:
+            stats.failed += 1
+            raise
+        else:
+            stats.finished += 1
+        finally:
+            stats.running -= 1
+            stats.run_seconds += monotonic() - started_at
+            self._semaphore.release()
+
+
+video_slots = EncoderSlots(ENCODER_WORKERS, ENCODER_QUEUE_SIZE)
+# audio cuts are mostly stream copies and must not wait behind video encodes
+audio_slots = EncoderSlots(AUDIO_ENCODER_WORKERS, 4 * AUDIO_ENCODER_WORKERS)
+# inline queries wait for frames, so they do not share slots with clips either
+frame_slots = EncoderSlots(FRAME_WORKERS, 4 * FRAME_WORKERS)
+stats = video_slots.stats
+
+
+async def start_ffmpeg(ff: FFmpeg, stdin=DEVNULL, stdout=None, stderr=None) -> asyncio.subprocess.Process:
+    try:
+        return await asyncio.create_subprocess_exec(*ff._cmd, stdin=stdin, stdout=stdout, stderr=stderr)
+    except FileNotFoundError:
+        raise FFExecutableNotFoundError(f"Executable '{ff.executable}' not found")
+
+
+async def wait_ffmpeg(ff: FFmpeg, process: asyncio.subprocess.Process,
+                      input_data: Optional[bytes] = None) -> Tuple[Optional[bytes], Optional[bytes]]:
+    try:
+        out = await process.communicate(input_data)
+    except asyncio.CancelledError:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+
+    if process.returncode != 0:
+        raise FFRuntimeError(ff.cmd, process.returncode, *out)
+    return out
+
+
+async def run_ffmpeg(ff: FFmpeg, input_data: Optional[bytes] = None,
+                     stdout=None, stderr=None, stage: str = 'ffmpeg_encode',
+                     slots: EncoderSlots = video_slots) -> Tuple[Optional[bytes], Optional[bytes]]:
+    async with slots.slot():
+        with STAGE_SECONDS.time(stage=stage):
+            process = await start_ffmpeg(ff,
+                                         stdin=DEVNULL if input_data is None else PIPE,
+                                         stdout=stdout,
+                                         stderr=stderr)
+            return await wait_ffmpeg(ff, process, input_data)
@@ -0,0 +1,42 @@
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Literal, Optional
+
+import youtube_dl
+
+import config
+
+EXTRACTOR_POOL: Literal['thread', 'process'] = getattr(config, 'EXTRACTOR_POOL', 'thread')
+EXTRACTOR_WORKERS: int = getattr(config, 'EXTRACTOR_WORKERS', 4)
+EXTRACTOR_TIMEOUT: float = getattr(config, 'EXTRACTOR_TIMEOUT', 30)
+
+
+def make_executor(pool: Literal['thread', 'process'], workers: int) -> Executor:
+    if pool == 'thread':
+        return ThreadPoolExecutor(max_workers=workers, thread_name_prefix='extractor')
+    elif pool == 'process':
+        return ProcessPoolExecutor(max_workers=workers)
+    else:
+        raise ValueError(pool)
+
+
+executor = make_executor(EXTRACTOR_POOL, EXTRACTOR_WORKERS)
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def _extract_info(youtube_url: str) -> dict:
+    options = dict(quiet=True)
+    with youtube_dl.YoutubeDL(options) as ydl:
+        return ydl.extract_info(youtube_url, download=False)
+
+
+async def extract_info(youtube_url: str, timeout: float = EXTRACTOR_TIMEOUT) -> dict:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(EXTRACTOR_WORKERS)
+
+    # Waiting for the semaphore is cancellable; a job that has already been
+    # handed to a worker runs to completion, but its result is dropped.
+    async with _semaphore:
+        future = asyncio.get_event_loop().run_in_executor(executor, _extract_info, youtube_url)
+        return await asyncio.wait_for(future, timeout)
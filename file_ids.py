@@ -0,0 +1,64 @@
+import sqlite3
+from time import time
+from typing import Literal, Optional
+
+from parse import Request
+
+ClipKind = Literal['video', 'audio']
+
+
+class FileIdStore:
+    def __init__(self, path: str, max_entries: int):
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS file_ids ('
+            '  youtube_id TEXT NOT NULL,'
+            '  start_s INTEGER NOT NULL,'
+            '  end_s INTEGER NOT NULL,'
+            '  kind TEXT NOT NULL,'
+            '  quality TEXT NOT NULL,'
+            '  file_id TEXT NOT NULL,'
+            '  used_at REAL NOT NULL,'
+            '  PRIMARY KEY (youtube_id, start_s, end_s, kind, quality)'
+            ')'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS file_ids_used_at ON file_ids (used_at)')
+
+    def get(self, request: Request, kind: ClipKind, quality: str) -> Optional[str]:
+        key = (request.youtube_id, request.start, request.end, kind, quality)
+        row = self.db.execute(
+            'SELECT file_id FROM file_ids'
+            ' WHERE youtube_id = ? AND start_s = ? AND end_s = ? AND kind = ? AND quality = ?',
+            key,
+        ).fetchone()
+        if row is None:
+            return None
+
+        self.db.execute(
+            'UPDATE file_ids SET used_at = ?'
+            ' WHERE youtube_id = ? AND start_s = ? AND end_s = ? AND kind = ? AND quality = ?',
+            (time(), *key),
+        )
+        return row[0]
+
+    def put(self, request: Request, kind: ClipKind, quality: str, file_id: str) -> None:
+        self.db.execute(
+            'INSERT OR REPLACE INTO file_ids VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (request.youtube_id, request.start, request.end, kind, quality, file_id, time()),
+        )
+        self.evict()
+
+    def evict(self) -> None:
+        (count,), = self.db.execute('SELECT COUNT(*) FROM file_ids')
+        if count > self.max_entries:
+            self.db.execute(
+                'DELETE FROM file_ids WHERE rowid IN'
+                ' (SELECT rowid FROM file_ids ORDER BY used_at LIMIT ?)',
+                (count - self.max_entries,),
+            )
+
+    def __len__(self) -> int:
+        (count,), = self.db.execute('SELECT COUNT(*) FROM file_ids')
+        return count
@@ -0,0 +1,136 @@
+import asyncio
+from dataclasses import dataclass
+from time import time
+from typing import Dict, List, Literal, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from funcy import project
+
+import config
+from extractor import extract_info
+from metrics import STAGE_SECONDS
+from profiles import AUDIO_COPY_EXTS, choose_profile, select_video_format
+from state import make_store
+
+FORMAT_CACHE_TTL: float = getattr(config, 'FORMAT_CACHE_TTL', 60 * 60)
+FORMAT_CACHE_SIZE: int = getattr(config, 'FORMAT_CACHE_SIZE', 1000)
+URL_EXPIRY_MARGIN = 5 * 60
+STATE_BACKEND = getattr(config, 'STATE_BACKEND', 'memory')
+STATE_DB = getattr(config, 'STATE_DB', 'state.sqlite3')
+
+FormatType = Literal['clip', 'preview', 'audio']
+FORMAT_TYPES = ('clip', 'preview', 'audio')
+
+# (ext, url)
+Format = Tuple[str, str]
+
+
+@dataclass
+class FormatCacheStats:
+    hits: int = 0
+    misses: int = 0
+    expired: int = 0
+    coalesced: int = 0
+
+
+stats = FormatCacheStats()
+
+# (youtube_id, type_) -> (expires_at, candidate formats)
+_cache = make_store(STATE_BACKEND, STATE_DB, 'formats', maxsize=FORMAT_CACHE_SIZE, ttl=FORMAT_CACHE_TTL)
+# youtube_id -> extraction shared by concurrent callers
+_in_flight: Dict[str, asyncio.Future] = {}
+
+
+def is_mp4_with_audio(x) -> bool:
+    return (x['ext'] == 'mp4'
+            and x['acodec'] != 'none')
+
+
+def is_with_audio(x) -> bool:
+    return x['acodec'] != 'none'
+
+
+def is_audio_only(x) -> bool:
+    return x['acodec'] != 'none' and x.get('vcodec') == 'none'
+
+
+def candidate_formats(info: dict, type_: FormatType) -> List[dict]:
+    if type_ in ('preview', 'clip'):
+        formats = filter(is_mp4_with_audio, info['formats'])
+    elif type_ == 'audio':
+        # audio-only DASH formats are a fraction of the size of muxed ones
+        formats = (list(filter(is_audio_only, info['formats']))
+                   or list(filter(is_with_audio, info['formats'])))
+    else:
+        raise ValueError(type_)
+
+    return [project(fmt, ['ext', 'url', 'height', 'tbr']) for fmt in formats]
+
+
+def select_format(candidates: List[dict], type_: FormatType, duration: int) -> Format:
+    if type_ == 'audio':
+        copyable = [fmt for fmt in candidates if fmt['ext'] in AUDIO_COPY_EXTS]
+        best_format = (copyable or candidates)[-1]
+    else:
+        best_format = select_video_format(candidates, choose_profile(type_, duration), duration)
+    return (best_format['ext'], best_format['url'])
+
+
+def url_expires_at(url: str) -> Optional[float]:
+    query = parse_qs(urlsplit(url).query)
+    try:
+        return float(query['expire'][0])
+    except (KeyError, ValueError):
+        return None
+
+
+def formats_expire_at(candidates: List[dict], now: float) -> float:
+    expires_at = [url_expires_at(fmt['url']) for fmt in candidates]
+    return min([now + FORMAT_CACHE_TTL,
+                *(e - URL_EXPIRY_MARGIN for e in expires_at if e is not None)])
+
+
+async def resolve_formats(youtube_id: str) -> Dict[FormatType, List[dict]]:
+    info = await extract_info('https://youtu.be/' + youtube_id)
+
+    now = time()
+    formats = {}
+    for type_ in FORMAT_TYPES:
+        candidates = candidate_formats(info, type_)
+        if candidates:
+            formats[type_] = candidates
+            _cache[(youtube_id, type_)] = (formats_expire_at(candidates, now), candidates)
+    return formats
+
+
+async def get_candidate_formats(youtube_id: str, type_: FormatType) -> List[dict]:
+    key = (youtube_id, type_)
+    cached = _cache.get(key)
+    if cached is not None:
+        expires_at, candidates = cached
+        if expires_at > time():
+            stats.hits += 1
+            return candidates
+        _cache.pop(key, None)
+        stats.expired += 1
+    stats.misses += 1
+
+    task = _in_flight.get(youtube_id)
+    if task is None:
+        task = asyncio.ensure_future(resolve_formats(youtube_id))
+        _in_flight[youtube_id] = task
+        task.add_done_callback(lambda _: _in_flight.pop(youtube_id, None))
+    else:
+        stats.coalesced += 1
+
+    # one cancelled caller must not cancel the extraction for the others
+    formats = await asyncio.shield(task)
+    try:
+        return formats[type_]
+    except KeyError:
+        raise ValueError(f'No {type_} format found for {youtube_id}')
+
+
+async def get_videofile_url(youtube_id: str, type_: FormatType = 'clip', duration: int = 0) -> Format:
+    with STAGE_SECONDS.time(stage='get_videofile_url'):
+        return select_format(await get_candidate_formats(youtube_id, type_), type_, duration)
@@ -0,0 +1,81 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional, Tuple
+
+from jobs import SingleFlight
+
+# (youtube_id, second) -> (photo jpeg, thumbnail jpeg)
+RenderFrame = Callable[[str, int], Awaitable[Tuple[bytes, bytes]]]
+# photo jpeg -> Telegram file_id
+UploadFrame = Callable[[bytes], Awaitable[str]]
+
+
+@dataclass
+class Frame:
+    photo: bytes
+    # at most 320px on each side, as Telegram requires of video thumbnails
+    thumb: bytes
+    file_id: Optional[str] = None
+
+
+@dataclass
+class FrameStats:
+    hits: int = 0
+    misses: int = 0
+    evicted: int = 0
+    uploads: int = 0
+
+
+class FrameCache:
+    # Frames at the start of requested ranges, rendered once per
+    # (youtube_id, second) and uploaded once. Thumbnails have to be uploaded
+    # with every video, so the images are kept along with the file_id.
+
+    def __init__(self, maxsize: int, render: RenderFrame, upload: UploadFrame):
+        self.maxsize = maxsize
+        self.stats = FrameStats()
+        self._render = render
+        self._upload = upload
+        self._frames: 'OrderedDict[Tuple[str, int], Frame]' = OrderedDict()
+        self._renders = SingleFlight()
+        self._uploads = SingleFlight()
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def peek(self, youtube_id: str, second: int) -> Optional[Frame]:
+        return self._frames.get((youtube_id, second))
+
+    def cached_file_id(self, youtube_id: str, second: int) -> Optional[str]:
+        frame = self.peek(youtube_id, second)
+        return frame.file_id if frame is not None else None
+
+    async def get(self, youtube_id: str, second: int) -> Frame:
+        key = (youtube_id, second)
+        frame = self._frames.get(key)
+        if frame is not None:
+            self._frames.move_to_end(key)
+            self.stats.hits += 1
+            return frame
+
+        self.stats.misses += 1
+        return await self._renders.run(key, lambda: self._render_frame(key))
+
+    async def file_id(self, youtube_id: str, second: int) -> str:
+        frame = await self.get(youtube_id, second)
+        if frame.file_id is None:
+            frame.file_id = await self._uploads.run((youtube_id, second), lambda: self._upload_frame(frame))
+        return frame.file_id
+
+    async def _render_frame(self, key: Tuple[str, int]) -> Frame:
+        frame = Frame(*await self._render(*key))
+        self._frames[key] = frame
+        while len(self._frames) > self.maxsize:
+            self._frames.popitem(last=False)
+            self.stats.evicted += 1
+        return frame
+
+    async def _upload_frame(self, frame: Frame) -> str:
+        file_id = await self._upload(frame.photo)
+        self.stats.uploads += 1
+        return file_id
@@ -0,0 +1,349 @@
+import asyncio
+import json
+import pickle
+from collections import OrderedDict, deque
+from dataclasses import asdict, dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional, TypeVar
+from uuid import uuid4
+
+from parse import Request
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+T = TypeVar('T')
+
+
+@dataclass
+class _Job:
+    task: asyncio.Future
+    waiters: int = 0
+    # some waiter got the result, or it was discarded
+    claimed: bool = False
+
+
+class SingleFlight:
+    # Runs one job per key for any number of waiters. A result that every
+    # waiter gave up on is passed to `discard`, e.g. to remove a file.
+
+    def __init__(self, discard: Optional[Callable[[Any], None]] = None):
+        self.discard = discard
+        self._jobs: Dict[Hashable, _Job] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._jobs
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    async def run(self, key: Hashable, make_job: Callable[[], Awaitable[T]]) -> T:
+        job = self._jobs.get(key)
+        if job is None:
+            job = _Job(asyncio.ensure_future(make_job()))
+            self._jobs[key] = job
+            job.task.add_done_callback(lambda _: self._forget(key, job))
+
+        job.waiters += 1
+        try:
+            result = await asyncio.shield(job.task)
+            job.claimed = True
+            return result
+        except asyncio.CancelledError:
+            # the last waiter to give up takes the job down with it
+            if job.waiters == 1 and not job.task.done():
+                job.task.cancel()
+            raise
+        finally:
+            job.waiters -= 1
+            self._discard_unclaimed(job)
+
+    def _forget(self, key: Hashable, job: _Job) -> None:
+        if self._jobs.get(key) is job:
+            del self._jobs[key]
+        self._discard_unclaimed(job)
+
+    def _discard_unclaimed(self, job: _Job) -> None:
+        # the job may finish after its last waiter left, or its waiters may
+        # all be cancelled between the job finishing and them waking up
+        if self.discard is None or job.waiters or job.claimed or not job.task.done():
+            return
+        if not job.task.cancelled() and job.task.exception() is None:
+            job.claimed = True
+            self.discard(job.task.result())
+
+
+PRIORITIES = {'preview': 0, 'audio': 1, 'clip': 2}
+
+
+@dataclass
+class ClipJob:
+    request: Request
+    kind: str
+    quality: str
+    chat_id: int
+    user_id: int
+    priority: Optional[int] = None
+    id: str = field(default_factory=lambda: uuid4().hex)
+
+    def __post_init__(self):
+        if self.priority is None:
+            self.priority = PRIORITIES[self.quality]
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self))
+
+    @classmethod
+    def from_json(cls, s: str) -> 'ClipJob':
+        d = json.loads(s)
+        return cls(**{**d, 'request': Request(**d['request'])})
+
+
+class LocalJobQueue:
+    def __init__(self):
+        # priority -> chat_id -> user_id -> jobs, chats and users are served round-robin
+        self._jobs: Dict[int, 'OrderedDict[int, OrderedDict[int, Deque[ClipJob]]]'] = {}
+        self._size = 0
+        self._not_empty: Optional[asyncio.Event] = None
+        self._results: Dict[str, asyncio.Future] = {}
+
+    def qsize(self) -> int:
+        return self._size
+
+    def _event(self) -> asyncio.Event:
+        if self._not_empty is None:
+            self._not_empty = asyncio.Event()
+        return self._not_empty
+
+    async def put(self, job: ClipJob) -> None:
+        self._results[job.id] = asyncio.get_event_loop().create_future()
+
+        chats = self._jobs.setdefault(job.priority, OrderedDict())
+        users = chats.setdefault(job.chat_id, OrderedDict())
+        users.setdefault(job.user_id, deque()).append(job)
+        self._size += 1
+        self._event().set()
+
+    async def get(self) -> ClipJob:
+        while not self._size:
+            self._event().clear()
+            await self._event().wait()
+
+        priority = min(self._jobs)
+        chats = self._jobs[priority]
+        chat_id, users = next(iter(chats.items()))
+        user_id, jobs = next(iter(users.items()))
+        job = jobs.popleft()
+
+        if jobs:
+            users.move_to_end(user_id)
+        else:
+            del users[user_id]
+        if users:
+            chats.move_to_end(chat_id)
+        else:
+            del chats[chat_id]
+        if not chats:
+            del self._jobs[priority]
+        self._size -= 1
+
+        return job
+
+    def is_wanted(self, job: ClipJob) -> bool:
+        future = self._results.get(job.id)
+        return future is not None and not future.done()
+
+    def on_abandoned(self, job: ClipJob, callback: Callable[[], None]) -> Callable[[], None]:
+        # returns a function that stops watching
+        future = self._results.get(job.id)
+        if future is None:
+            return lambda: None
+
+        def on_done(f: asyncio.Future) -> None:
+            if f.cancelled():
+                callback()
+
+        future.add_done_callback(on_done)
+        return lambda: future.remove_done_callback(on_done)
+
+    def abandon(self, job: ClipJob) -> None:
+        future = self._results.get(job.id)
+        if future is not None and not future.done():
+            future.cancel()
+
+    async def set_result(self, job: ClipJob, result) -> bool:
+        # False if nobody waits for the result any more
+        future = self._results.get(job.id)
+        if future is None or future.done():
+            return False
+        future.set_result(result)
+        return True
+
+    async def set_exception(self, job: ClipJob, exc: BaseException) -> None:
+        future = self._results.get(job.id)
+        if future is not None and not future.done():
+            future.set_exception(exc)
+
+    async def wait(self, job: ClipJob):
+        try:
+            return await self._results[job.id]
+        finally:
+            self._results.pop(job.id, None)
+
+
+class RedisJobQueue:
+    # Jobs are shared by every process connected to the same server and are
+    # served strictly by priority; per-chat fairness is only done locally.
+    # Results are pickled, so results and exceptions must be picklable.
+
+    # how often a running job checks whether its waiter gave up
+    ABANDON_POLL = 1
+
+    def __init__(self, url: str, prefix: str = 'clip-jobs'):
+        if aioredis is None:
+            raise RuntimeError('the redis package is required for the redis job queue')
+        self.redis = aioredis.from_url(url)
+        self.prefix = prefix
+        self._queues = [f'{prefix}:{priority}' for priority in sorted(set(PRIORITIES.values()))]
+        self._size = 0
+
+    def _result_key(self, job: ClipJob) -> str:
+        return f'{self.prefix}:result:{job.id}'
+
+    def _abandoned_key(self, job: ClipJob) -> str:
+        return f'{self.prefix}:abandoned:{job.id}'
+
+    def qsize(self) -> int:
+        # the length of the shared queue as of this process' last put or get
+        return self._size
+
+    async def _update_size(self) -> None:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for queue in self._queues:
+                pipe.llen(queue)
+            self._size = sum(await pipe.execute())
+
+    async def put(self, job: ClipJob) -> None:
+        await self.redis.rpush(f'{self.prefix}:{job.priority}', job.to_json())
+        await self._update_size()
+
+    async def get(self) -> ClipJob:
+        _, payload = await self.redis.blpop(self._queues)
+        await self._update_size()
+        return ClipJob.from_json(payload.decode())
+
+    def is_wanted(self, job: ClipJob) -> bool:
+        return True
+
+    def on_abandoned(self, job: ClipJob, callback: Callable[[], None]) -> Callable[[], None]:
+        async def watch():
+            while not await self.redis.exists(self._abandoned_key(job)):
+                await asyncio.sleep(self.ABANDON_POLL)
+            callback()
+
+        watcher = asyncio.ensure_future(watch())
+        return watcher.cancel
+
+    def abandon(self, job: ClipJob) -> None:
+        asyncio.ensure_future(self._abandon(job))
+
+    async def _abandon(self, job: ClipJob) -> None:
+        # a job nobody has taken yet is dropped, a running one is told to stop
+        await self.redis.lrem(f'{self.prefix}:{job.priority}', 1, job.to_json())
+        await self.redis.set(self._abandoned_key(job), 1, ex=60 * 60)
+        # ends the wait for a result that will not come
+        await self._push_result(job, (False, asyncio.CancelledError()))
+        await self._update_size()
+
+    async def _push_result(self, job: ClipJob, outcome) -> None:
+        key = self._result_key(job)
+        await self.redis.rpush(key, pickle.dumps(outcome))
+        await self.redis.expire(key, 60 * 60)
+
+    async def set_result(self, job: ClipJob, result) -> bool:
+        if await self.redis.exists(self._abandoned_key(job)):
+            return False
+        await self._push_result(job, (True, result))
+        return True
+
+    async def set_exception(self, job: ClipJob, exc: BaseException) -> None:
+        await self._push_result(job, (False, exc))
+
+    async def wait(self, job: ClipJob):
+        _, payload = await self.redis.blpop([self._result_key(job)])
+        ok, value = pickle.loads(payload)
+        if ok:
+            return value
+        raise value
+
+
+class WorkerPool:
+    # Runs jobs from `queue` with `workers` concurrent handlers. A result that
+    # nobody is waiting for any more is passed to `discard`.
+
+    def __init__(self, queue, handler: Callable[[ClipJob], Awaitable[T]], workers: int,
+                 discard: Optional[Callable[[T], None]] = None):
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.discard = discard
+        self._tasks: List[asyncio.Task] = []
+        self.running = 0
+
+    def start(self) -> None:
+        self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def drain(self, timeout: float) -> bool:
+        deadline = asyncio.get_event_loop().time() + timeout
+        while self.queue.qsize() > 0 or self.running:
+            if asyncio.get_event_loop().time() > deadline:
+                return False
+            await asyncio.sleep(0.1)
+        return True
+
+    async def submit(self, job: ClipJob) -> T:
+        await self.queue.put(job)
+        waiting = asyncio.ensure_future(self.queue.wait(job))
+        try:
+            return await asyncio.shield(waiting)
+        except asyncio.CancelledError:
+            # stops the job, a result that is already on its way is discarded
+            self.queue.abandon(job)
+            waiting.add_done_callback(self._discard_result)
+            raise
+
+    def _discard_result(self, future: asyncio.Future) -> None:
+        if self.discard is not None and not future.cancelled() and future.exception() is None:
+            self.discard(future.result())
+
+    async def _work(self) -> None:
+        while True:
+            job = await self.queue.get()
+            if not self.queue.is_wanted(job):
+                continue
+
+            task = asyncio.ensure_future(self.handler(job))
+            unwatch = self.queue.on_abandoned(job, task.cancel)
+            self.running += 1
+            try:
+                result = await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if not task.cancelled():
+                    # the worker itself is being stopped
+                    task.cancel()
+                    raise
+            except Exception as e:
+                await self.queue.set_exception(job, e)
+            else:
+                if not await self.queue.set_result(job, result) and self.discard is not None:
+                    self.discard(result)
+            finally:
+                unwatch()
+                self.running -= 1
@@ -0,0 +1,13 @@
+import logging
+
+from pygogo import Gogo
+
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+
+def make_logger(name: str) -> logging.Logger:
+    return Gogo(
+        name,
+        low_formatter=formatter,
+        high_formatter=formatter
+    ).logger
@@ -0,0 +1,212 @@
+from contextlib import contextmanager
+from dataclasses import fields
+from time import monotonic
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from aiogram import Bot, types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for v in labels.values())
+    return '{' + ','.join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + '}'
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric) -> None:
+        if metric.name in self._metrics:
+            raise ValueError(f'{metric.name} is already registered')
+        self._metrics[metric.name] = metric
+
+    def unregister(self, name: str) -> None:
+        self._metrics.pop(name, None)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), registry: Optional[Registry] = REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labels):
+            raise ValueError(f'{self.name} expects labels {self.labels}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self) -> List[Sample]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[Sample]:
+        return [(self.name, dict(zip(self.labels, key)), value) for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    # Either set explicitly or read from `function` on every scrape.
+    type = 'gauge'
+
+    def __init__(self, *args, function: Optional[Callable[[], float]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.function = function
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def samples(self) -> List[Sample]:
+        if self.function is not None:
+            return [(self.name, {}, self.function())]
+        return [(self.name, dict(zip(self.labels, key)), value) for key, value in self._values.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # label values -> (bucket counts, sum)
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        counts, total = self._values.get(key) or ([0] * len(self.buckets), 0.0)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        started_at = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - started_at, **labels)
+
+    def samples(self) -> List[Sample]:
+        samples = []
+        for key, (counts, total) in self._values.items():
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', {**labels, 'le': format_value(bound)}, cumulative))
+            samples.append((f'{self.name}_sum', labels, total))
+            samples.append((f'{self.name}_count', labels, cumulative))
+        return samples
+
+
+class StatsCollector(Metric):
+    # Exports the fields of one of the modules' stats dataclasses, e.g.
+    # formats.stats, as `<name>{field="..."}`.
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, stats, registry: Optional[Registry] = REGISTRY):
+        super().__init__(name, help, labels=('field',), registry=registry)
+        self.stats = stats
+
+    def samples(self) -> List[Sample]:
+        return [(self.name, {'field': f.name}, getattr(self.stats, f.name)) for f in fields(self.stats)]
+
+
+STAGE_SECONDS = Histogram('clipbot_stage_seconds', 'Time spent in each stage of handling a request.',
+                          labels=('stage',))
+UPDATES = Counter('clipbot_updates_total', 'Updates received, by type.', labels=('type',))
+
+TELEGRAM_SECONDS = Histogram('clipbot_telegram_request_seconds', 'Bot API request latency, by method.',
+                             labels=('method',))
+TELEGRAM_QUEUE_SECONDS = Histogram('clipbot_telegram_queue_seconds',
+                                   'Time Bot API requests waited for the rate limits, by method.', labels=('method',))
+
+# Bot API methods that are also stages of handling a request
+API_STAGES = {
+    'sendVideo': 'upload',
+    'sendAudio': 'upload',
+    'editMessageMedia': 'edit_message_media',
+}
+
+UPDATE_TYPES = ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'inline_query',
+                'chosen_inline_result', 'callback_query')
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    async def on_pre_process_update(self, update: types.Update, data: dict) -> None:
+        update_type = next((name for name in UPDATE_TYPES if getattr(update, name, None)), 'other')
+        UPDATES.inc(type=update_type)
+        data['received_at'] = monotonic()
+
+    async def on_post_process_update(self, update: types.Update, result, data: dict) -> None:
+        STAGE_SECONDS.observe(monotonic() - data['received_at'], stage='update')
+
+
+class InstrumentedBot(Bot):
+    async def request(self, method, data=None, files=None, **kwargs):
+        started_at = monotonic()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        finally:
+            elapsed = monotonic() - started_at
+            TELEGRAM_SECONDS.observe(elapsed, method=method)
+            if method in API_STAGES:
+                STAGE_SECONDS.observe(elapsed, stage=API_STAGES[method])
+
+
+def metrics_handler(registry: Registry = REGISTRY):
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(body=registry.render().encode(),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+    return handle
+
+
+async def start_metrics_server(host: str, port: int, registry: Registry = REGISTRY) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler(registry))
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
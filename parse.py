@@ -1,9 +1,8 @@
 from dataclasses import dataclass
-from typing import Optional, Tuple, Dict
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 import re
 
-from furl import furl
-from funcy import project, walk_values, first
+from funcy import first
 
 
 @dataclass
@@ -25,28 +24,59 @@ def first_some(seq):
     return first(x for x in seq if x is not None)
 
 
+YOUTUBE_HOST_RE = re.compile(r'(https?://)?(((www|m)\.)?youtube\.com|youtu\.be)\b')
+
+# every link shape that names a single video, matched in one scan
+YOUTUBE_URL_RE = re.compile(
+    r'(?:https?://)?'
+    r'(?:'
+      r'(?:(?:www|m)\.)?youtube\.com/'
+      r'(?:watch|(?P<kind>shorts|embed|live)/(?P<path_id>[\w-]+)/?)'
+      r'|youtu\.be/(?P<short_id>[\w-]+)/?'
+    r')'
+    r'(?:\?(?P<query>[^#]*))?'
+    r'(?:#.*)?',
+    re.ASCII,
+)
+
+QUERY_ARG_RE = re.compile(r'(?:^|&)(v|t|start)=([^&]*)')
+
+
 def is_youtube_url(possible_yt_video_url: str) -> bool:
-    return bool(re.match(r'(https?://)?((www\.)?youtube\.com|youtu\.be)\b', possible_yt_video_url))
+    return YOUTUBE_HOST_RE.match(possible_yt_video_url) is not None
+
+
+def parse_youtube_url(yt_url: str) -> Optional[Tuple[str, Optional[str]]]:
+    # (video id, t) of a link to a single video, None for anything else
+    found = YOUTUBE_URL_RE.fullmatch(yt_url)
+    if found is None:
+        return None
+
+    youtube_id = found['path_id'] or found['short_id']
+    t = None
+    query = found['query']
+    if query:
+        # the first occurrence of an argument wins
+        for arg in QUERY_ARG_RE.finditer(query):
+            name, value = arg.groups()
+            if name == 'v':
+                if youtube_id is None:
+                    youtube_id = value
+            elif name == 't' or found['kind'] == 'embed':
+                if t is None:
+                    t = value
+    if not youtube_id:
+        return None
+    return youtube_id, t
 
 
 def youtube_url_as_dict(yt_url: str) -> Dict[str, str]:
-    yt_url_with_schema = yt_url if yt_url.startswith('http') else 'https://' + yt_url
-    f = furl(yt_url_with_schema)
+    link = parse_youtube_url(yt_url)
+    if link is None:
+        return {}
 
-    if f.host.endswith('youtube.com'):
-        if str(f.path) == '/watch' and 'v' in f.args:
-            return project(f.args, ['v', 't'])
-        else:
-            return {}
-
-    else:  # youtu.be
-        if f.path.segments:
-            return {
-                'v': f.path.segments[0],
-                **project(f.args, ['t']),
-            }
-        else:
-            return {}
+    youtube_id, t = link
+    return {'v': youtube_id} if t is None else {'v': youtube_id, 't': t}
 
 
 HMS_PATTERN = (
@@ -68,6 +98,13 @@ COLONS_PATTERN = (
 )
 
 
+# a time token with an optional end prefix, in one compiled pattern
+TIME_RE = re.compile(
+    r'(?P<prefix>\+|\.\.)?'
+    r'(?:' + HMS_PATTERN + r'|' + COLONS_PATTERN.replace('(?P<', '(?P<c') + r')'
+)
+
+
 def hms_to_seconds(h: int, m: int, s: int) -> int:
     return (
           h * 60 * 60
@@ -76,10 +113,6 @@ def hms_to_seconds(h: int, m: int, s: int) -> int:
     )
 
 
-def match_to_seconds(m):
-    return hms_to_seconds(**walk_values(int, m.groupdict(default='0')))
-
-
 def match_int(s: str) -> Optional[int]:
     try:
         return int(s)
@@ -87,48 +120,54 @@ def match_int(s: str) -> Optional[int]:
         return None
 
 
-def match_time_pattern(time_pattern: str, s: str) -> Optional[int]:
-    found = re.search(r'^' + time_pattern + r'$', s)
-    if found:
-        return match_to_seconds(found)
-    else:
+def match_time(s: str) -> Optional[Tuple[str, bool, int]]:
+    # (prefix, whether it is in the colons form, seconds)
+    found = TIME_RE.fullmatch(s)
+    if found is None:
         return None
 
+    h, m, sec, ch, cm, cs = found.group('h', 'm', 's', 'ch', 'cm', 'cs')
+    if cm is None:
+        return found['prefix'] or '', False, hms_to_seconds(int(h or 0), int(m or 0), int(sec or 0))
+    else:
+        return found['prefix'] or '', True, hms_to_seconds(int(ch or 0), int(cm), int(cs))
+
 
 def match_start(s: str) -> Optional[int]:
-    return first_some([match_int(s),
-                       match_time_pattern(HMS_PATTERN, s),
-                       match_time_pattern(COLONS_PATTERN, s)])
+    start = match_int(s)
+    if start is not None:
+        return start
+
+    found = match_time(s)
+    if found is None or found[0]:
+        return None
+    return found[2]
 
 
 def match_t_start(s: str) -> Optional[int]:
-    return first_some([match_int(s),
-                       match_time_pattern(HMS_PATTERN, s)])
-
+    start = match_int(s)
+    if start is not None:
+        return start
 
+    found = match_time(s)
+    if found is None or found[0] or found[1]:
+        return None
+    return found[2]
 
-def match_end(s: str) -> Optional[Tuple[str, int]]:
-    try:
-        return ('relative', int(s))
-    except ValueError:
-        pass
 
-    found = first_some([re.search(r'^\+' +    HMS_PATTERN + r'$', s),
-                        re.search(r'^\+' + COLONS_PATTERN + r'$', s)])
-    if found:
-        return ('relative', match_to_seconds(found))
+END_TYPES = {'+': 'relative', '..': 'ellipsis', '': 'absolute'}
 
-    found = first_some([re.search(r'^\.\.' +    HMS_PATTERN + r'$', s),
-                        re.search(r'^\.\.' + COLONS_PATTERN + r'$', s)])
-    if found:
-        return ('ellipsis', match_to_seconds(found))
 
-    found = first_some([re.search(r'^' +    HMS_PATTERN + r'$', s),
-                        re.search(r'^' + COLONS_PATTERN + r'$', s)])
-    if found:
-        return ('absolute', match_to_seconds(found))
+def match_end(s: str) -> Optional[Tuple[str, int]]:
+    end = match_int(s)
+    if end is not None:
+        return ('relative', end)
 
-    return None
+    found = match_time(s)
+    if found is None:
+        return None
+    prefix, _, seconds = found
+    return (END_TYPES[prefix], seconds)
 
 
 def seconds_to_ts(val: int) -> Timestamp:
@@ -188,50 +227,41 @@ def raw_end_to_absolute(start: int, raw_end: Tuple[str, int]) -> Optional[int]:
         raise ValueError(raw_end)
 
 
-def match_request(s: str) -> Optional[Request]:
-    tokens = s.split()
-    if len(tokens) == 2:
-        maybe_yt_url_with_hms, maybe_end = tokens
+def match_tokens(tokens: List[str], link: Optional[Tuple[str, Optional[str]]] = None) -> Optional[Request]:
+    if len(tokens) not in (2, 3):
+        return None
 
-        if not is_youtube_url(maybe_yt_url_with_hms):
+    # the caller may have parsed the link already
+    if link is None:
+        link = parse_youtube_url(tokens[0])
+        if link is None:
             return None
+    youtube_id, t = link
 
-        yt_dict = youtube_url_as_dict(maybe_yt_url_with_hms)
-
-        if 'v' not in set(yt_dict):
-            return None
-        youtube_id = yt_dict['v']
+    if len(tokens) == 2:
+        _, maybe_end = tokens
 
-        if 't' not in set(yt_dict):
+        if t is None:
             if maybe_end == 'full':
                 maybe_end = '10:00'
                 start = 0
             else:
                 return None
         else:
-            start = match_t_start(yt_dict['t'])
+            start = match_t_start(t)
             if start is None:
                 return None
 
-    elif len(tokens) == 3:
-        maybe_yt_url, maybe_start, maybe_end = tokens
-
-        if not is_youtube_url(maybe_yt_url):
-            return None
+    else:
+        _, maybe_start, maybe_end = tokens
 
-        yt_dict = youtube_url_as_dict(maybe_yt_url)
-        if {'v'} != set(yt_dict):
+        if t is not None:
             return None
 
-        youtube_id = yt_dict['v']
-
         start = match_start(maybe_start)
         if start is None:
             return None
 
-    else:
-        return None
-
     raw_end = match_end(maybe_end)
     if raw_end is None:
         return None
@@ -247,3 +277,57 @@ def match_request(s: str) -> Optional[Request]:
         raise ValueError('Maximum clip length is 10 minutes')
 
     return Request(youtube_id, start, end)
+
+
+def match_request(s: str) -> Optional[Request]:
+    return match_tokens(s.split())
+
+
+def match_requests(lines: Iterable[str]) -> List[Union[Request, ValueError, None]]:
+    # one result per line, an invalid range is returned instead of raised
+    results = []
+    for line in lines:
+        try:
+            results.append(match_request(line))
+        except ValueError as e:
+            results.append(e)
+    return results
+
+
+def find_requests(s: str) -> List[Union[Request, ValueError]]:
+    # every link in the text together with the tokens up to the next link,
+    # e.g. a list of timestamped links, one per line
+    tokens = s.split()
+    links = [(i, link) for i, link in enumerate(map(parse_youtube_url, tokens)) if link is not None]
+    ends = [i for i, _ in links[1:]] + [len(tokens)]
+
+    results = []
+    for (start, link), end in zip(links, ends):
+        try:
+            # anything after the range, like a comment, is ignored
+            request = (match_tokens(tokens[start:min(end, start + 3)], link)
+                       or match_tokens(tokens[start:min(end, start + 2)], link))
+        except ValueError as e:
+            results.append(e)
+        else:
+            if request is not None:
+                results.append(request)
+    return results
+
+
+# inline queries are typed incrementally, so a missing end is filled in
+INLINE_COMPLETIONS = ([], ['10'], ['0', '10'])
+
+
+def match_inline_query(s: str) -> Optional[Request]:
+    tokens = s.split()
+    # most keystrokes are not a link yet
+    link = parse_youtube_url(tokens[0]) if tokens else None
+    if link is None:
+        return None
+
+    for completion in INLINE_COMPLETIONS:
+        request = match_tokens(tokens + completion, link)
+        if request is not None:
+            return request
+    return None
@@ -0,0 +1,81 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+# Bot API limit for files uploaded by bots
+TELEGRAM_UPLOAD_LIMIT = 50 * 1000 * 1000
+# room for container overhead and rate control overshoot
+SIZE_HEADROOM = 0.85
+MIN_VIDEO_BITRATE = 200
+# containers whose audio (AAC) send_audio accepts as is, once remuxed to m4a;
+# opus from webm is not accepted and has to be encoded to mp3
+AUDIO_COPY_EXTS = ('m4a', 'mp4')
+
+
+@dataclass(frozen=True)
+class EncodingProfile:
+    max_height: Optional[int] = None
+    preset: str = 'veryfast'
+    crf: int = 23
+    audio_bitrate: int = 128  # kbit/s
+
+
+# action -> [(longest clip in seconds, profile)], shortest first
+PROFILES: Dict[str, List[Tuple[int, EncodingProfile]]] = {
+    'clip': [
+        (60, EncodingProfile(max_height=1080, preset='veryfast', crf=21, audio_bitrate=192)),
+        (180, EncodingProfile(max_height=720, preset='veryfast', crf=23, audio_bitrate=128)),
+        (600, EncodingProfile(max_height=480, preset='superfast', crf=25, audio_bitrate=96)),
+    ],
+    'preview': [
+        (600, EncodingProfile(max_height=360, preset='ultrafast', crf=30, audio_bitrate=64)),
+    ],
+    'audio': [
+        (180, EncodingProfile(audio_bitrate=192)),
+        (600, EncodingProfile(audio_bitrate=128)),
+    ],
+}
+
+
+def choose_profile(action: str, duration: int) -> EncodingProfile:
+    profiles = PROFILES[action]
+    for longest, profile in profiles:
+        if duration <= longest:
+            return profile
+    return profiles[-1][1]
+
+
+def max_video_bitrate(profile: EncodingProfile, duration: int) -> int:
+    total = TELEGRAM_UPLOAD_LIMIT * 8 * SIZE_HEADROOM / 1000 / max(duration, 1)
+    return max(int(total) - profile.audio_bitrate, MIN_VIDEO_BITRATE)
+
+
+def estimated_size(fmt: dict, duration: int) -> Optional[float]:
+    if not fmt.get('tbr'):
+        return None
+    return fmt['tbr'] * 1000 / 8 * duration
+
+
+def select_video_format(candidates: List[dict], profile: EncodingProfile, duration: int) -> dict:
+    # youtube_dl lists formats from worst to best
+    fitting = [
+        fmt for fmt in candidates
+        if (profile.max_height is None or (fmt.get('height') or 0) <= profile.max_height)
+        and (estimated_size(fmt, duration) or 0) <= TELEGRAM_UPLOAD_LIMIT
+    ]
+    return fitting[-1] if fitting else candidates[0]
+
+
+def video_options(profile: EncodingProfile, duration: int) -> List[str]:
+    bitrate = max_video_bitrate(profile, duration)
+    options = ['-c:v', 'libx264',
+               '-preset', profile.preset,
+               '-crf', str(profile.crf),
+               '-maxrate', f'{bitrate}k',
+               '-bufsize', f'{2 * bitrate}k']
+    if profile.max_height is not None:
+        options += ['-vf', f"scale=-2:'min({profile.max_height},ih)'"]
+    return options
+
+
+def audio_options(profile: EncodingProfile) -> List[str]:
+    return ['-b:a', f'{profile.audio_bitrate}k']
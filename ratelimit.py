@@ -0,0 +1,187 @@
+import asyncio
+import os
+from dataclasses import dataclass
+from functools import partial
+from time import monotonic
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from aiogram.types import InputFile
+from aiogram.utils.exceptions import RetryAfter
+from cachetools import LRUCache
+
+from metrics import TELEGRAM_QUEUE_SECONDS, InstrumentedBot
+
+# methods that count against Telegram's message limits
+SCHEDULED_PREFIXES = ('send', 'edit', 'copy', 'forward')
+# a chat action is not a message, and a late one shows a stale status
+UNSCHEDULED = ('sendChatAction',)
+# a newer edit of the same message makes an unsent older one pointless
+COLLAPSIBLE = ('editMessageCaption', 'editMessageText', 'editMessageReplyMarkup')
+
+
+@dataclass
+class ApiSchedulerStats:
+    queued: int = 0
+    sent: int = 0
+    collapsed: int = 0
+    retried: int = 0
+    retry_after_seconds: float = 0
+
+
+class TokenBucket:
+    # Hands out tokens in FIFO order at `rate` per second, up to `burst` at
+    # once. pause() holds everyone back after Telegram asked to retry later.
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated_at = monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, monotonic() + seconds)
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def chat_of(data: Dict[str, Any]) -> Optional[Hashable]:
+    return data.get('chat_id') or data.get('inline_message_id')
+
+
+def collapse_key(method: str, data: Dict[str, Any]) -> Optional[Hashable]:
+    if method not in COLLAPSIBLE:
+        return None
+    return method, data.get('inline_message_id') or (data.get('chat_id'), data.get('message_id'))
+
+
+class PendingEdit:
+    def __init__(self, make_request: Callable[[], Awaitable]):
+        self.make_request = make_request
+        self.task: Optional[asyncio.Task] = None
+
+
+class ApiScheduler:
+    # Sends Bot API requests through a per-chat and a global token bucket,
+    # retries after flood waits and drops edits that a newer edit of the
+    # same message replaced while they were waiting for their turn.
+
+    def __init__(self, rate: float = 30, chat_rate: float = 1, chat_burst: float = 5,
+                 max_retries: int = 3, max_chats: int = 10_000):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.stats = ApiSchedulerStats()
+        self._global = TokenBucket(rate, rate)
+        # only chats that sent recently have a partly drained bucket worth keeping
+        self._chats: LRUCache = LRUCache(max_chats)
+        self._pending: Dict[Hashable, PendingEdit] = {}
+
+    def _bucket(self, chat: Hashable) -> TokenBucket:
+        bucket = self._chats.get(chat)
+        if bucket is None:
+            bucket = self._chats[chat] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def call(self, method: str, data: Dict[str, Any], make_request: Callable[[], Awaitable],
+                   retry: bool = True):
+        chat = chat_of(data)
+        if chat is None or not method.startswith(SCHEDULED_PREFIXES) or method in UNSCHEDULED:
+            return await make_request()
+
+        key = collapse_key(method, data)
+        if key is None:
+            return await self._send(method, chat, None, make_request, retry)
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            # whoever sent the older edit gets the result of the newer one
+            pending.make_request = make_request
+            self.stats.collapsed += 1
+        else:
+            pending = self._pending[key] = PendingEdit(make_request)
+            pending.task = asyncio.ensure_future(self._send(method, chat, key, lambda: pending.make_request()))
+        return await asyncio.shield(pending.task)
+
+    async def _send(self, method: str, chat: Hashable, key: Optional[Hashable],
+                    make_request: Callable[[], Awaitable], retry: bool = True):
+        bucket = self._bucket(chat)
+        queued_at = monotonic()
+        self.stats.queued += 1
+        try:
+            await bucket.acquire()
+            await self._global.acquire()
+        finally:
+            self.stats.queued -= 1
+            if key is not None:
+                # from here on a newer edit of the message is sent after this one
+                del self._pending[key]
+        TELEGRAM_QUEUE_SECONDS.observe(monotonic() - queued_at, method=method)
+
+        max_retries = self.max_retries if retry else 0
+        for attempt in range(max_retries + 1):
+            if attempt:
+                await bucket.acquire()
+                await self._global.acquire()
+            try:
+                result = await make_request()
+            except RetryAfter as e:
+                # whatever comes next in the chat has to wait either way
+                bucket.pause(e.timeout)
+                if attempt == max_retries:
+                    raise
+                self.stats.retried += 1
+                self.stats.retry_after_seconds += e.timeout
+            else:
+                self.stats.sent += 1
+                return result
+
+
+def reopen_files(files: Dict) -> Optional[Callable[[], Dict]]:
+    # aiohttp closes a file once it has sent it, so a retried upload has to
+    # open it again. Only files on disk can be, anything else is sent once.
+    paths = {}
+    for key, f in files.items():
+        fileobj = f.file if isinstance(f, InputFile) else f
+        path = getattr(fileobj, 'name', None)
+        if not isinstance(path, str) or not os.path.isfile(path):
+            return None
+        paths[key] = path, f.filename if isinstance(f, InputFile) else os.path.basename(path)
+    return lambda: {key: InputFile(path, filename=filename) for key, (path, filename) in paths.items()}
+
+
+class ScheduledBot(InstrumentedBot):
+    def __init__(self, *args, scheduler: Optional[ApiScheduler] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        send = partial(super().request, method, data, **kwargs)
+        if self.scheduler is None:
+            return await send(files)
+        if not files:
+            return await self.scheduler.call(method, data or {}, lambda: send(files))
+
+        reopen = reopen_files(files)
+        attempts = 0
+
+        async def make_request():
+            nonlocal attempts
+            attempts += 1
+            return await send(files if attempts == 1 else reopen())
+
+        return await self.scheduler.call(method, data or {}, make_request, retry=reopen is not None)
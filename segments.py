@@ -0,0 +1,107 @@
+import os
+import shutil
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Hashable, Optional
+
+from profiles import TELEGRAM_UPLOAD_LIMIT, EncodingProfile, max_video_bitrate
+
+
+def kbps(profile: EncodingProfile, duration: int) -> int:
+    # the most a clip of `duration` encoded with `profile` may take per second
+    return profile.audio_bitrate + max_video_bitrate(profile, duration)
+
+
+@dataclass
+class Segment:
+    path: str
+    end: int
+    # the source format the segment was cut from, see sourcecache.source_key
+    source: str
+    profile: EncodingProfile
+    size: int
+
+
+@dataclass
+class SegmentCacheStats:
+    extended: int = 0
+    trimmed: int = 0
+    misses: int = 0
+    evicted: int = 0
+
+
+class SegmentCache:
+    # Keeps the last rendered clip for every (youtube_id, start, kind, quality),
+    # so that moving the end of a range with the +N/-N buttons only has to
+    # encode the difference.
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.stats = SegmentCacheStats()
+        self._segments: 'OrderedDict[Hashable, Segment]' = OrderedDict()
+        self._counter = 0
+
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+
+    def __len__(self) -> int:
+        return len(self._segments)
+
+    def find(self, key: Hashable, start: int, end: int, source: str,
+             profile: EncodingProfile) -> Optional[Segment]:
+        # An extended segment keeps its own profile, which may differ from
+        # `profile` once the clip grows past a profile's longest duration,
+        # e.g. 60s to 65s. The delta has to be encoded with segment.profile.
+        segment = self._segments.get(key)
+        if segment is None or segment.end == end:
+            self.stats.misses += 1
+            return None
+
+        if end < segment.end:
+            if segment.profile != profile:
+                self.stats.misses += 1
+                return None
+            # trimming only copies packets, the source does not matter
+            self.stats.trimmed += 1
+        elif segment.source != source:
+            # a different format may differ in resolution or codec
+            self.stats.misses += 1
+            return None
+        else:
+            added = kbps(segment.profile, end - start) * 1000 // 8 * (end - segment.end)
+            if segment.size + added > TELEGRAM_UPLOAD_LIMIT:
+                self.stats.misses += 1
+                return None
+            self.stats.extended += 1
+
+        self._segments.move_to_end(key)
+        return segment
+
+    def put(self, key: Hashable, path: str, end: int, source: str, profile: EncodingProfile) -> None:
+        self._counter += 1
+        stored = os.path.join(self.directory, f'{self._counter}{os.path.splitext(path)[1]}')
+        try:
+            os.link(path, stored)
+        except OSError:
+            shutil.copyfile(path, stored)
+
+        self._remove(key)
+        size = os.path.getsize(stored)
+        self._segments[key] = Segment(stored, end, source, profile, size)
+        self.size += size
+        self._evict()
+
+    def _remove(self, key: Hashable) -> None:
+        segment = self._segments.pop(key, None)
+        if segment is not None:
+            os.remove(segment.path)
+            self.size -= segment.size
+
+    def _evict(self) -> None:
+        while self.size > self.max_bytes and len(self._segments) > 1:
+            key = next(iter(self._segments))
+            self._remove(key)
+            self.stats.evicted += 1
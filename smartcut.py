@@ -0,0 +1,191 @@
+import asyncio
+import json
+import os
+from subprocess import PIPE
+from typing import List, Optional, Tuple
+
+from ffmpy import FFmpeg, FFprobe, FFRuntimeError
+
+from encoder import run_ffmpeg
+from log import make_logger
+from profiles import EncodingProfile, audio_options, max_video_bitrate
+
+# the audio track is cut separately, so the two may drift by about a frame
+SYNC_TOLERANCE = 0.1
+# the copied middle must start exactly on its keyframe, not one GOP earlier
+SEEK_EPSILON = 0.001
+
+X264_PROFILES = {
+    'Constrained Baseline': 'baseline',
+    'Baseline': 'baseline',
+    'Main': 'main',
+    'High': 'high',
+}
+
+logger = make_logger(__name__)
+
+
+class SmartCutError(Exception):
+    pass
+
+
+async def probe_json(url: str, options: List[str]) -> dict:
+    ff = FFprobe(inputs={url: ['-v', 'error', '-of', 'json', *options]})
+    out, _ = await run_ffmpeg(ff, stdout=PIPE, stage='ffprobe')
+    return json.loads(out)
+
+
+async def probe_video_stream(url: str) -> dict:
+    info = await probe_json(url, ['-select_streams', 'v:0',
+                                  '-show_entries', 'stream=codec_name,profile,pix_fmt,time_base,height'])
+    try:
+        return info['streams'][0]
+    except (KeyError, IndexError):
+        raise SmartCutError('no video stream')
+
+
+async def probe_keyframes(url: str, start: float, end: float) -> List[float]:
+    info = await probe_json(url, ['-select_streams', 'v:0',
+                                  '-skip_frame', 'nokey',
+                                  '-read_intervals', f'{start}%{end}',
+                                  '-show_entries', 'frame=pts_time'])
+    return sorted(float(frame['pts_time'])
+                  for frame in info.get('frames', [])
+                  if frame.get('pts_time') not in (None, 'N/A'))
+
+
+def plan_copy_range(keyframes: List[float], start: float, end: float) -> Optional[Tuple[float, float]]:
+    inside = [k for k in keyframes if start <= k <= end]
+    if len(inside) < 2:
+        return None
+    return inside[0], inside[-1]
+
+
+def x264_options(stream: dict, profile: EncodingProfile, duration: float) -> List[str]:
+    bitrate = max_video_bitrate(profile, int(duration))
+    options = ['-c:v', 'libx264',
+               '-preset', profile.preset,
+               '-crf', str(profile.crf),
+               '-maxrate', f'{bitrate}k',
+               '-bufsize', f'{2 * bitrate}k']
+    if stream.get('profile') in X264_PROFILES:
+        options += ['-profile:v', X264_PROFILES[stream['profile']]]
+    if stream.get('pix_fmt'):
+        options += ['-pix_fmt', stream['pix_fmt']]
+    return options
+
+
+def timescale_options(stream: dict) -> List[str]:
+    # the copied middle keeps the source's exact timestamps
+    if stream.get('time_base'):
+        return ['-video_track_timescale', stream['time_base'].split('/')[-1]]
+    return []
+
+
+async def check_av_sync(path: str, duration: float) -> None:
+    info = await probe_json(path, ['-show_entries', 'stream=codec_type,start_time,duration'])
+    streams = {s['codec_type']: s for s in info.get('streams', [])}
+    if set(streams) != {'video', 'audio'}:
+        raise SmartCutError(f'unexpected streams {sorted(streams)}')
+
+    video, audio = streams['video'], streams['audio']
+    drift = abs(float(video['duration']) - float(audio['duration']))
+    offset = abs(float(video['start_time']) - float(audio['start_time']))
+    if drift > SYNC_TOLERANCE or offset > SYNC_TOLERANCE:
+        raise SmartCutError(f'audio/video out of sync: drift {drift:.3f}s, offset {offset:.3f}s')
+    if abs(float(video['duration']) - duration) > 2 * SYNC_TOLERANCE:
+        raise SmartCutError(f'expected {duration}s of video, got {video["duration"]}s')
+
+
+async def check_decodes(path: str) -> None:
+    # a full decode, the probe in check_av_sync does not look at the frames
+    ff = FFmpeg(inputs={path: None}, outputs={'-': ['-f', 'null']}, global_options='-v error')
+    try:
+        _, errors = await run_ffmpeg(ff, stderr=PIPE, stage='ffmpeg_check')
+    except FFRuntimeError as e:
+        errors = e.stderr or b'ffmpeg failed'
+    if errors.strip():
+        raise SmartCutError(f'{path} does not decode: {errors.decode(errors="replace").strip()}')
+
+
+async def smart_cut(url: str, start: float, end: float, profile: EncodingProfile,
+                    out_file_path: str, work_dir: str) -> None:
+    stream = await probe_video_stream(url)
+    if stream.get('codec_name') != 'h264':
+        raise SmartCutError(f'cannot join libx264 edges to {stream.get("codec_name")}')
+    if profile.max_height is not None and stream.get('height', 0) > profile.max_height:
+        raise SmartCutError(f'{stream["height"]}p source has to be scaled down to {profile.max_height}p')
+
+    copy_range = plan_copy_range(await probe_keyframes(url, start, end), start, end)
+    if copy_range is None:
+        raise SmartCutError('no complete GOP inside the range')
+    copy_start, copy_end = copy_range
+
+    def part(name: str) -> str:
+        return os.path.join(work_dir, name)
+
+    # The pieces are cut to MPEG-TS, where every piece carries its own SPS and
+    # PPS in the stream. An mp4 has a single avcC, taken from the first piece,
+    # which does not describe the copied middle nor a separately encoded edge.
+    edge_options = x264_options(stream, profile, end - start)
+    # (ffmpeg, stage)
+    jobs = []
+    segments = []
+    if copy_start > start:
+        segments.append(part('head.ts'))
+        jobs.append((FFmpeg(
+            inputs={url: ['-ss', str(start)]},
+            outputs={part('head.ts'): ['-t', str(copy_start - start), '-an', *edge_options]},
+            global_options='-v warning'
+        ), 'ffmpeg_encode'))
+    segments.append(part('middle.ts'))
+    jobs.append((FFmpeg(
+        inputs={url: ['-ss', str(copy_start + SEEK_EPSILON)]},
+        outputs={part('middle.ts'): ['-t', str(copy_end - copy_start), '-an', '-c:v', 'copy',
+                                     '-bsf:v', 'h264_mp4toannexb', '-avoid_negative_ts', 'make_zero']},
+        global_options='-v warning'
+    ), 'ffmpeg_cut'))
+    if end > copy_end:
+        segments.append(part('tail.ts'))
+        jobs.append((FFmpeg(
+            inputs={url: ['-ss', str(copy_end)]},
+            outputs={part('tail.ts'): ['-t', str(end - copy_end), '-an', *edge_options]},
+            global_options='-v warning'
+        ), 'ffmpeg_encode'))
+    jobs.append((FFmpeg(
+        inputs={url: ['-ss', str(start)]},
+        outputs={part('audio.m4a'): ['-t', str(end - start), '-vn', '-c:a', 'aac', *audio_options(profile)]},
+        global_options='-v warning'
+    ), 'ffmpeg_encode'))
+
+    for ff, _ in jobs:
+        logger.info(ff.cmd)
+    # the pieces are independent, so they are cut concurrently within the encoder limit
+    await gather_or_cancel([run_ffmpeg(ff, stage=stage) for ff, stage in jobs])
+
+    with open(part('segments.txt'), 'w') as f:
+        for segment in segments:
+            f.write(f"file '{segment}'\n")
+
+    ff = FFmpeg(
+        inputs={part('segments.txt'): ['-f', 'concat', '-safe', '0'],
+                part('audio.m4a'): None},
+        outputs={out_file_path: ['-map', '0:v', '-map', '1:a', '-c', 'copy', *timescale_options(stream),
+                                 '-movflags', '+faststart']},
+        global_options='-v warning'
+    )
+    logger.info(ff.cmd)
+    await run_ffmpeg(ff, stage='ffmpeg_cut')
+
+    await check_av_sync(out_file_path, end - start)
+
+
+async def gather_or_cancel(aws):
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
@@ -0,0 +1,183 @@
+import asyncio
+import hashlib
+import os
+import re
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import aiohttp
+from aiohttp import web
+
+from jobs import SingleFlight
+
+BLOCK_SIZE = 1 << 20
+
+RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+@dataclass
+class SourceCacheStats:
+    hits: int = 0
+    misses: int = 0
+    evicted: int = 0
+    fetched_bytes: int = 0
+
+
+def source_key(youtube_id: str, url: str) -> str:
+    # signed URLs change between extractions, the itag names the same bytes
+    itag = parse_qs(urlsplit(url).query).get('itag')
+    suffix = itag[0] if itag else hashlib.md5(urlsplit(url).path.encode()).hexdigest()
+    return re.sub(r'[^\w-]', '_', f'{youtube_id}-{suffix}')
+
+
+def parse_range(header: Optional[str], total: int) -> Optional[Tuple[int, int]]:
+    if header is None:
+        return 0, total - 1
+
+    found = RANGE_RE.match(header.strip())
+    if not found:
+        return None
+    first, last = found.groups()
+    if not first:
+        # suffix range: the last N bytes
+        if not last:
+            return None
+        return max(total - int(last), 0), total - 1
+
+    start = int(first)
+    end = min(int(last), total - 1) if last else total - 1
+    if start > end:
+        return None
+    return start, end
+
+
+class SourceCache:
+    # Serves remote source media to ffmpeg over a local HTTP endpoint and
+    # keeps the fetched bytes on disk in fixed-size blocks, so that cutting
+    # an overlapping range of the same video reads mostly from disk.
+
+    def __init__(self, directory: str, max_bytes: int, block_size: int = BLOCK_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.size = 0
+        self.stats = SourceCacheStats()
+        self.base_url: Optional[str] = None
+
+        # (key, block index) -> block size, least recently used first
+        self._blocks: 'OrderedDict[Tuple[str, int], int]' = OrderedDict()
+        self._sources: Dict[str, str] = {}
+        self._lengths: Dict[str, int] = {}
+        self._fetches = SingleFlight()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+
+        app = web.Application()
+        app.router.add_get('/{key}', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+
+        host, port = self._runner.addresses[0][:2]
+        self.base_url = f'http://{host}:{port}'
+        self._session = aiohttp.ClientSession()
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+        if self._session is not None:
+            await self._session.close()
+
+    def source_url(self, youtube_id: str, url: str) -> str:
+        key = source_key(youtube_id, url)
+        self._sources[key] = url
+        return f'{self.base_url}/{key}'
+
+    def _path(self, key: str, index: int) -> str:
+        return os.path.join(self.directory, f'{key}.{index}')
+
+    async def _block(self, key: str, index: int) -> bytes:
+        if (key, index) in self._blocks:
+            self._blocks.move_to_end((key, index))
+            self.stats.hits += 1
+            with open(self._path(key, index), 'rb') as f:
+                return f.read()
+
+        self.stats.misses += 1
+        return await self._fetches.run((key, index), lambda: self._fetch(key, index))
+
+    async def _fetch(self, key: str, index: int) -> bytes:
+        first = index * self.block_size
+        last = first + self.block_size - 1
+        async with self._session.get(self._sources[key], headers={'Range': f'bytes={first}-{last}'}) as response:
+            if response.status != 206:
+                raise web.HTTPBadGateway(text=f'upstream answered {response.status} to a range request')
+            self._lengths[key] = int(response.headers['Content-Range'].rsplit('/', 1)[1])
+            data = await response.read()
+
+        with open(self._path(key, index), 'wb') as f:
+            f.write(data)
+        self._blocks[(key, index)] = len(data)
+        self.size += len(data)
+        self.stats.fetched_bytes += len(data)
+        self._evict()
+        return data
+
+    def _evict(self) -> None:
+        while self.size > self.max_bytes and len(self._blocks) > 1:
+            (key, index), size = self._blocks.popitem(last=False)
+            os.remove(self._path(key, index))
+            self.size -= size
+            self.stats.evicted += 1
+
+    async def _handle(self, request: web.Request) -> web.StreamResponse:
+        key = request.match_info['key']
+        if key not in self._sources:
+            raise web.HTTPNotFound()
+
+        if key not in self._lengths:
+            await self._block(key, 0)
+        total = self._lengths[key]
+
+        byte_range = parse_range(request.headers.get('Range'), total)
+        if byte_range is None:
+            raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': f'bytes */{total}'})
+        start, end = byte_range
+
+        response = web.StreamResponse(
+            status=206 if 'Range' in request.headers else 200,
+            headers={
+                'Accept-Ranges': 'bytes',
+                'Content-Length': str(end - start + 1),
+                'Content-Range': f'bytes {start}-{end}/{total}',
+            },
+        )
+        await response.prepare(request)
+
+        first_block, last_block = start // self.block_size, end // self.block_size
+        next_block = asyncio.ensure_future(self._block(key, first_block))
+        try:
+            for index in range(first_block, last_block + 1):
+                data = await next_block
+                # fetch ahead while the current block is being sent
+                if index < last_block:
+                    next_block = asyncio.ensure_future(self._block(key, index + 1))
+
+                offset = index * self.block_size
+                await response.write(data[max(start - offset, 0):end - offset + 1])
+        except ConnectionResetError:
+            # ffmpeg drops the connection whenever it seeks
+            return response
+        finally:
+            next_block.cancel()
+
+        await response.write_eof()
+        return response
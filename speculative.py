@@ -0,0 +1,96 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+
+
+@dataclass
+class SpeculationStats:
+    started: int = 0
+    over_budget: int = 0
+    hits: int = 0
+    misses: int = 0
+    wasted: int = 0
+    cancelled: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        claimed = self.hits + self.misses
+        return self.hits / claimed if claimed else 0.0
+
+
+@dataclass
+class _Speculation:
+    task: asyncio.Future
+    owner: Hashable
+    expiry: Optional[asyncio.TimerHandle] = None
+
+
+class Speculator:
+    # Starts work that a user is likely to ask for next. At most `budget`
+    # speculations run at once, each owner (a user) has at most one, and
+    # work nobody claims within `ttl` seconds is counted as wasted and
+    # cancelled if it is still running.
+
+    def __init__(self, budget: int, ttl: float):
+        self.budget = budget
+        self.ttl = ttl
+        self.stats = SpeculationStats()
+        self._speculations: Dict[Hashable, _Speculation] = {}
+        self._by_owner: Dict[Hashable, Hashable] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._speculations
+
+    def running(self) -> int:
+        return sum(not s.task.done() for s in self._speculations.values())
+
+    def speculate(self, key: Hashable, owner: Hashable, make_job: Callable[[], Awaitable]) -> bool:
+        if key in self._speculations:
+            return True
+
+        previous = self._by_owner.get(owner)
+        if previous is not None:
+            # the owner has moved on, e.g. kept typing the inline query
+            self._drop(previous, cancel=True)
+
+        if self.running() >= self.budget:
+            self.stats.over_budget += 1
+            return False
+
+        speculation = _Speculation(asyncio.ensure_future(make_job()), owner)
+        speculation.task.add_done_callback(self._retrieve_exception)
+        speculation.expiry = asyncio.get_event_loop().call_later(self.ttl, self._drop, key, True)
+        self._speculations[key] = speculation
+        self._by_owner[owner] = key
+        self.stats.started += 1
+        return True
+
+    def claim(self, key: Hashable) -> bool:
+        speculation = self._speculations.pop(key, None)
+        if speculation is None:
+            self.stats.misses += 1
+            return False
+
+        speculation.expiry.cancel()
+        if self._by_owner.get(speculation.owner) == key:
+            del self._by_owner[speculation.owner]
+        self.stats.hits += 1
+        return True
+
+    def _drop(self, key: Hashable, cancel: bool) -> None:
+        speculation = self._speculations.pop(key, None)
+        if speculation is None:
+            return
+
+        speculation.expiry.cancel()
+        if self._by_owner.get(speculation.owner) == key:
+            del self._by_owner[speculation.owner]
+        self.stats.wasted += 1
+        if cancel and not speculation.task.done():
+            speculation.task.cancel()
+            self.stats.cancelled += 1
+
+    @staticmethod
+    def _retrieve_exception(task: asyncio.Future) -> None:
+        if not task.cancelled():
+            task.exception()
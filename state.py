@@ -0,0 +1,275 @@
+import json
+import mmap
+import os
+import sqlite3
+import struct
+from dataclasses import dataclass
+from time import time
+from typing import Any, Hashable, Iterator, List, Literal, MutableMapping, Optional, Tuple
+
+from cachetools import TTLCache
+
+# chat_id, message_id -> message_id, a value of 0 marks a deleted key
+SLOT = struct.Struct('<qII')
+# magic, capacity, sequence, used slots, live entries
+HEADER = struct.Struct('<4sIQQQ')
+MAGIC = b'MSG1'
+MAX_LOAD = 0.75
+FIBONACCI = 0x9E3779B97F4A7C15
+
+
+class SQLiteStore(MutableMapping):
+    # A TTLCache look-alike shared by every process that opens the same file.
+    # Keys and values go through JSON, so tuples come back as lists.
+
+    def __init__(self, path: str, namespace: str, maxsize: int, ttl: float):
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.db = sqlite3.connect(path, isolation_level=None, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS state ('
+            '  namespace TEXT NOT NULL,'
+            '  key TEXT NOT NULL,'
+            '  value TEXT NOT NULL,'
+            '  expires_at REAL NOT NULL,'
+            '  PRIMARY KEY (namespace, key)'
+            ')'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS state_expires_at ON state (namespace, expires_at)')
+
+    def __getitem__(self, key: Hashable) -> Any:
+        row = self.db.execute(
+            'SELECT value FROM state WHERE namespace = ? AND key = ? AND expires_at > ?',
+            (self.namespace, json.dumps(key), time()),
+        ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __setitem__(self, key: Hashable, value: Any) -> None:
+        self.db.execute(
+            'INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?)',
+            (self.namespace, json.dumps(key), json.dumps(value), time() + self.ttl),
+        )
+        self.expire()
+
+    def __delitem__(self, key: Hashable) -> None:
+        cursor = self.db.execute(
+            'DELETE FROM state WHERE namespace = ? AND key = ?',
+            (self.namespace, json.dumps(key)),
+        )
+        if not cursor.rowcount:
+            raise KeyError(key)
+
+    def __iter__(self):
+        rows = self.db.execute(
+            'SELECT key FROM state WHERE namespace = ? AND expires_at > ?',
+            (self.namespace, time()),
+        ).fetchall()
+        return (json.loads(key) for key, in rows)
+
+    def __len__(self) -> int:
+        (count,), = self.db.execute(
+            'SELECT COUNT(*) FROM state WHERE namespace = ? AND expires_at > ?',
+            (self.namespace, time()),
+        )
+        return count
+
+    def expire(self) -> None:
+        self.db.execute('DELETE FROM state WHERE namespace = ? AND expires_at <= ?', (self.namespace, time()))
+        (count,), = self.db.execute('SELECT COUNT(*) FROM state WHERE namespace = ?', (self.namespace,))
+        if count > self.maxsize:
+            # every entry lives for the same ttl, so the first to expire is the oldest
+            self.db.execute(
+                'DELETE FROM state WHERE rowid IN'
+                ' (SELECT rowid FROM state WHERE namespace = ? ORDER BY expires_at LIMIT ?)',
+                (self.namespace, count - self.maxsize),
+            )
+
+
+def pack_key(chat_id: int, message_id: int) -> int:
+    return (chat_id << 32) | message_id
+
+
+class PackedTable:
+    # An open addressing hash table with linear probing in one flat buffer,
+    # a bytearray or a mmap of a file, 16 bytes per slot.
+
+    def __init__(self, buffer, capacity: int):
+        self.buffer = buffer
+        self.capacity = capacity
+        magic, stored_capacity, self.sequence, self.used, self.live = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC or stored_capacity != capacity:
+            self.clear(0)
+
+    def clear(self, sequence: int) -> None:
+        self.buffer[HEADER.size:] = bytes(len(self.buffer) - HEADER.size)
+        self.sequence, self.used, self.live = sequence, 0, 0
+        self._write_header()
+
+    def full(self) -> bool:
+        # whether the next new key would reach the load limit, the table keeps
+        # at least one empty slot, or _find would never end for a missing key
+        return self.used + 1 >= self.capacity * MAX_LOAD
+
+    def _write_header(self) -> None:
+        HEADER.pack_into(self.buffer, 0, MAGIC, self.capacity, self.sequence, self.used, self.live)
+
+    def _find(self, chat_id: int, message_id: int) -> Tuple[int, int]:
+        # (offset of the key's slot or of the empty slot it would go to, value or -1 if absent)
+        # a 64 bit hash scaled to the capacity, which need not be a power of two
+        index = (((pack_key(chat_id, message_id) * FIBONACCI) & 0xFFFF_FFFF_FFFF_FFFF) * self.capacity) >> 64
+        while True:
+            offset = HEADER.size + index * SLOT.size
+            slot_chat_id, slot_message_id, value = SLOT.unpack_from(self.buffer, offset)
+            if slot_chat_id == 0:
+                return offset, -1
+            if slot_chat_id == chat_id and slot_message_id == message_id:
+                return offset, value
+            index = index + 1 if index + 1 < self.capacity else 0
+
+    def get(self, chat_id: int, message_id: int) -> Optional[int]:
+        _, value = self._find(chat_id, message_id)
+        return value if value > 0 else None
+
+    def put(self, chat_id: int, message_id: int, value: int) -> None:
+        offset, previous = self._find(chat_id, message_id)
+        if previous < 0:
+            self.used += 1
+        if previous <= 0:
+            self.live += 1
+        SLOT.pack_into(self.buffer, offset, chat_id, message_id, value)
+        self._write_header()
+
+    def delete(self, chat_id: int, message_id: int) -> bool:
+        # the key keeps its slot, so that probing for keys after it still works
+        offset, previous = self._find(chat_id, message_id)
+        if previous <= 0:
+            return False
+        SLOT.pack_into(self.buffer, offset, chat_id, message_id, 0)
+        self.live -= 1
+        self._write_header()
+        return True
+
+    def __iter__(self) -> Iterator[Tuple[int, int, int]]:
+        for chat_id, message_id, value in SLOT.iter_unpack(self.buffer[HEADER.size:]):
+            if chat_id != 0 and value != 0:
+                yield chat_id, message_id, value
+
+
+@dataclass
+class MessageStoreStats:
+    hits: int = 0
+    misses: int = 0
+    promoted: int = 0
+    evicted: int = 0
+
+
+class MessageStore(MutableMapping):
+    # (chat_id, message_id) -> message_id in `generations` equal hash tables
+    # that together take at most `max_bytes`. Writes go to the newest table;
+    # once it is full, the oldest one is emptied and becomes the newest, and
+    # keys read from older tables are moved into the newest one. With a path,
+    # the tables are mmaps of `path.<n>` files and survive restarts.
+
+    def __init__(self, max_bytes: int, path: Optional[str] = None, generations: int = 4):
+        capacity = (max_bytes // generations - HEADER.size) // SLOT.size
+        if capacity < 2:
+            raise ValueError(f'{max_bytes} bytes is too small for {generations} generations')
+        size = HEADER.size + capacity * SLOT.size
+        self.max_bytes = max_bytes
+        self.stats = MessageStoreStats()
+        self._files = []
+
+        tables = []
+        for n in range(generations):
+            if path is None:
+                buffer = bytearray(size)
+            else:
+                fd = os.open(f'{path}.{n}', os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    if os.fstat(fd).st_size != size:
+                        os.ftruncate(fd, size)
+                    buffer = mmap.mmap(fd, size)
+                finally:
+                    os.close(fd)
+                self._files.append(buffer)
+            tables.append(PackedTable(buffer, capacity))
+        # newest first
+        self._tables: List[PackedTable] = sorted(tables, key=lambda t: t.sequence, reverse=True)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(len(table.buffer) for table in self._tables)
+
+    def close(self) -> None:
+        for buffer in self._files:
+            buffer.flush()
+            buffer.close()
+        self._files = []
+
+    def __getitem__(self, key: Tuple[int, int]) -> int:
+        chat_id, message_id = key
+        for age, table in enumerate(self._tables):
+            value = table.get(chat_id, message_id)
+            if value is not None:
+                self.stats.hits += 1
+                if age:
+                    # still in use, so it should not go with its generation
+                    self[key] = value
+                    self.stats.promoted += 1
+                return value
+        self.stats.misses += 1
+        raise KeyError(key)
+
+    def __contains__(self, key: Tuple[int, int]) -> bool:
+        # only a check, it neither counts as a hit nor keeps the key alive
+        chat_id, message_id = key
+        return any(table.get(chat_id, message_id) is not None for table in self._tables)
+
+    def __setitem__(self, key: Tuple[int, int], value: int) -> None:
+        chat_id, message_id = key
+        if chat_id == 0 or value <= 0:
+            raise ValueError(f'cannot store {key} -> {value}')
+
+        for table in self._tables[1:]:
+            table.delete(chat_id, message_id)
+        newest = self._tables[0]
+        if newest.get(chat_id, message_id) is None and newest.full():
+            oldest = self._tables.pop()
+            self.stats.evicted += oldest.live
+            oldest.clear(newest.sequence + 1)
+            self._tables.insert(0, oldest)
+            newest = oldest
+        newest.put(chat_id, message_id, value)
+
+    def __delitem__(self, key: Tuple[int, int]) -> None:
+        chat_id, message_id = key
+        if not any([table.delete(chat_id, message_id) for table in self._tables]):
+            raise KeyError(key)
+
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        for table in self._tables:
+            for chat_id, message_id, _ in table:
+                yield chat_id, message_id
+
+    def items(self) -> Iterator[Tuple[Tuple[int, int], int]]:
+        # reading through __getitem__ would move entries while iterating
+        for table in self._tables:
+            for chat_id, message_id, value in table:
+                yield (chat_id, message_id), value
+
+    def __len__(self) -> int:
+        return sum(table.live for table in self._tables)
+
+
+def make_store(backend: Literal['memory', 'sqlite'], path: str,
+               namespace: str, maxsize: int, ttl: float) -> MutableMapping:
+    if backend == 'memory':
+        return TTLCache(maxsize=maxsize, ttl=ttl)
+    elif backend == 'sqlite':
+        return SQLiteStore(path, namespace, maxsize=maxsize, ttl=ttl)
+    else:
+        raise ValueError(backend)
@@ -0,0 +1,104 @@
+import asyncio
+import multiprocessing
+import signal
+from typing import List, Optional
+
+from aiogram import Bot, Dispatcher, types
+
+from log import make_logger
+
+logger = make_logger(__name__)
+
+
+def update_chat_id(update: dict) -> Optional[int]:
+    for kind in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        if kind in update:
+            return update[kind]['chat']['id']
+
+    for kind in ('callback_query', 'inline_query', 'chosen_inline_result'):
+        if kind in update:
+            return update[kind]['from']['id']
+
+    return None
+
+
+def shard_of(update: dict, shards: int) -> int:
+    chat_id = update_chat_id(update)
+    return 0 if chat_id is None else chat_id % shards
+
+
+def shard_name(index: int) -> str:
+    # also names the shard's files and cache directories, so it must not change between runs
+    return f'shard-{index}'
+
+
+def run_shard(updates: multiprocessing.Queue, index: int, shards: int) -> None:
+    # The supervisor owns shutdown and tells shards to stop through their
+    # queues. A process manager may signal the whole group, e.g. systemd, and
+    # a shard must not be killed before it has drained.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    # imported here so that loading this module does not need config.py
+    import app
+
+    loop = asyncio.get_event_loop()
+    dispatcher = app.build_app(loop, shard_index=index, shards=shards)
+    Bot.set_current(dispatcher.bot)
+    Dispatcher.set_current(dispatcher)
+
+    async def consume():
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                return
+            asyncio.ensure_future(dispatcher.process_update(types.Update(**data)))
+
+    loop.run_until_complete(app.on_startup(dispatcher))
+    try:
+        loop.run_until_complete(consume())
+    finally:
+        loop.run_until_complete(app.on_shutdown(dispatcher))
+        loop.run_until_complete(dispatcher.bot.session.close())
+
+
+async def poll_updates(bot: Bot, queues: List[multiprocessing.Queue]) -> None:
+    await bot.delete_webhook()
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=20)
+        except Exception as e:
+            logger.exception(e)
+            await asyncio.sleep(1)
+            continue
+
+        for update in updates:
+            data = update.to_python()
+            queues[shard_of(data, len(queues))].put(data)
+            offset = update.update_id + 1
+
+
+def start_supervisor(bot: Bot, loop: asyncio.AbstractEventLoop, shards: int) -> None:
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue() for _ in range(shards)]
+    processes = [context.Process(target=run_shard, args=(queue, i, shards), name=shard_name(i))
+                 for i, queue in enumerate(queues)]
+    for process in processes:
+        process.start()
+
+    # SIGTERM is how systemd and docker stop a service, it has to stop the
+    # shards as cleanly as Ctrl+C
+    polling = asyncio.ensure_future(poll_updates(bot, queues), loop=loop)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, polling.cancel)
+    try:
+        loop.run_until_complete(polling)
+    except (asyncio.CancelledError, KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            process.join()
+        loop.run_until_complete(bot.session.close())
@@ -1,4 +1,44 @@
-from parse import is_youtube_url, youtube_url_as_dict, match_start, hms_to_seconds, match_request, Request
+import asyncio
+import os
+import subprocess
+import sys
+from io import BytesIO
+from time import time
+from types import ModuleType
+
+import aiohttp
+import pytest
+from aiogram.bot.api import TelegramAPIServer
+from aiogram.types import InputFile
+from aiogram.utils.exceptions import RetryAfter
+from aiohttp import web
+from cachetools import TTLCache
+
+try:
+    import config
+except ImportError:
+    # config.py belongs to the deployment, the modules below only need the
+    # two settings without a default
+    config = sys.modules['config'] = ModuleType('config')
+    config.TOKEN, config.BOT_CHANNEL_ID = '1:a', -1
+
+import app
+import formats
+from debounce import Debouncer, finish
+from encoder import EncoderBusy, EncoderSlots, accepted
+from file_ids import FileIdStore
+from frames import FrameCache
+from jobs import ClipJob, LocalJobQueue, SingleFlight, WorkerPool
+from metrics import Counter, Gauge, Histogram, Registry, StatsCollector
+from parse import is_youtube_url, youtube_url_as_dict, match_start, hms_to_seconds, match_request, Request, \
+    find_requests, match_inline_query, match_requests
+from profiles import EncodingProfile, choose_profile, select_video_format
+from ratelimit import ApiScheduler, ScheduledBot
+from segments import SegmentCache
+from sourcecache import SourceCache, parse_range
+from speculative import SpeculationStats, Speculator
+from state import HEADER, SLOT, MessageStore, SQLiteStore
+from supervisor import shard_of
 
 
 def test_is_youtube_url():
@@ -71,6 +111,24 @@ def test_youtube_url_as_dict_with_time():
         assert youtube_url_as_dict(u) == {'v': 'Bx51eegLTY8', 't': '2m33s'}
 
 
+def test_youtube_url_as_dict_other_shapes():
+    cases = [
+        ('https://m.youtube.com/watch?v=Bx51eegLTY8&t=2m33s', {'v': 'Bx51eegLTY8', 't': '2m33s'}),
+        ('https://youtube.com/shorts/Bx51eegLTY8?feature=share', {'v': 'Bx51eegLTY8'}),
+        ('https://www.youtube.com/embed/Bx51eegLTY8?start=153', {'v': 'Bx51eegLTY8', 't': '153'}),
+        ('https://www.youtube.com/live/Bx51eegLTY8?si=abc&t=95', {'v': 'Bx51eegLTY8', 't': '95'}),
+        ('https://www.youtube.com/watch?feature=share&v=Bx51eegLTY8', {'v': 'Bx51eegLTY8'}),
+        ('https://youtu.be/Bx51eegLTY8?t', {'v': 'Bx51eegLTY8'}),
+        ('https://youtube.com/feed/subscriptions', {}),
+        ('https://www.youtube.com/watch?v', {}),
+        ('https://youtu.be/', {}),
+        ('https://youtube.com.example.org/Bx51eegLTY8', {}),
+    ]
+
+    for u, out in cases:
+        assert youtube_url_as_dict(u) == out, u
+
+
 def test_match_start():
     assert match_start('1h20m18s') == hms_to_seconds(1, 20, 18)
     assert match_start('1:20:18')  == hms_to_seconds(1, 20, 18)
@@ -131,3 +189,684 @@ def test_match_request():
 
     for inp, out in cases:
         assert match_request(inp) == out
+
+
+def test_match_inline_query_completes_missing_end():
+    assert match_inline_query('https://youtu.be/C0DPdy98e4c?t=1m') == Request('C0DPdy98e4c', 60, 70)
+    assert match_inline_query('https://youtu.be/C0DPdy98e4c') == Request('C0DPdy98e4c', 0, 10)
+    assert match_inline_query('https://youtu.be/C0DPdy98e4c 1m') == Request('C0DPdy98e4c', 60, 70)
+    assert match_inline_query('https://youtu.be/C0DPdy98e4c 1m 1m5s') == Request('C0DPdy98e4c', 60, 65)
+    assert match_inline_query('https://yout') is None
+
+
+def test_find_requests_in_a_list_of_links():
+    found = find_requests(
+        'two moments:\n'
+        'https://youtu.be/C0DPdy98e4c?t=1m 10 the intro\n'
+        'https://www.youtube.com/watch?v=Bx51eegLTY8 1:00 1:30\n'
+        'https://youtu.be/C0DPdy98e4c 20 5s\n'
+        'https://youtu.be/Bx51eegLTY8 and that is all'
+    )
+    assert found[:2] == [Request('C0DPdy98e4c', 60, 70), Request('Bx51eegLTY8', 60, 90)]
+    assert len(found) == 3 and isinstance(found[2], ValueError)
+
+
+def test_match_requests_returns_errors_per_line():
+    ok, error, nothing = match_requests([
+        'https://youtu.be/C0DPdy98e4c 10 20',
+        'https://youtu.be/C0DPdy98e4c 20 5s',
+        'hello',
+    ])
+    assert ok == Request('C0DPdy98e4c', 10, 30)
+    assert isinstance(error, ValueError)
+    assert nothing is None
+
+
+def test_file_id_store_evicts_least_recently_used():
+    store = FileIdStore(':memory:', max_entries=2)
+    a, b, c = Request('a', 0, 10), Request('b', 0, 10), Request('c', 0, 10)
+
+    store.put(a, 'video', 'clip', 'file-a')
+    store.put(b, 'video', 'clip', 'file-b')
+    assert store.get(a, 'video', 'clip') == 'file-a'
+    assert store.get(a, 'audio', 'clip') is None
+
+    store.put(c, 'video', 'clip', 'file-c')
+    assert len(store) == 2
+    assert store.get(b, 'video', 'clip') is None
+    assert store.get(a, 'video', 'clip') == 'file-a'
+
+
+def test_single_flight_shares_and_cancels_jobs():
+    async def scenario():
+        started = 0
+
+        async def job():
+            nonlocal started
+            started += 1
+            await asyncio.sleep(0.01)
+            return 'result'
+
+        flights = SingleFlight()
+        results = await asyncio.gather(*[flights.run('key', job) for _ in range(3)])
+        assert results == ['result'] * 3
+        assert started == 1
+        assert 'key' not in flights
+
+        waiters = [asyncio.ensure_future(flights.run('key', job)) for _ in range(2)]
+        await asyncio.sleep(0)
+        task = flights._jobs['key'].task
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert task.cancelled()
+
+    asyncio.run(scenario())
+
+
+def test_local_job_queue_order():
+    async def scenario():
+        queue = LocalJobQueue()
+        request = Request('C0DPdy98e4c', 0, 10)
+        jobs = [
+            ClipJob(request, 'video', 'clip', chat_id=1, user_id=1),
+            ClipJob(request, 'video', 'clip', chat_id=1, user_id=1),
+            ClipJob(request, 'video', 'clip', chat_id=1, user_id=2),
+            ClipJob(request, 'video', 'clip', chat_id=2, user_id=3),
+            ClipJob(request, 'video', 'preview', chat_id=1, user_id=1),
+        ]
+        for job in jobs:
+            await queue.put(job)
+
+        order = [await queue.get() for _ in jobs]
+        assert [job.id for job in order] == [jobs[i].id for i in [4, 0, 3, 2, 1]]
+
+    asyncio.run(scenario())
+
+
+def test_worker_pool_runs_jobs():
+    async def scenario():
+        async def handler(job):
+            return job.request.end - job.request.start
+
+        pool = WorkerPool(LocalJobQueue(), handler, workers=2)
+        pool.start()
+        job = ClipJob(Request('C0DPdy98e4c', 5, 15), 'video', 'clip', chat_id=1, user_id=1)
+        assert await pool.submit(job) == 10
+        await pool.stop()
+
+    asyncio.run(scenario())
+
+
+def test_worker_pool_cancels_abandoned_jobs():
+    async def scenario():
+        cancelled = []
+
+        async def handler(job):
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                cancelled.append(job.id)
+                raise
+
+        pool = WorkerPool(LocalJobQueue(), handler, workers=1)
+        pool.start()
+        job = ClipJob(Request('C0DPdy98e4c', 5, 15), 'video', 'clip', chat_id=1, user_id=1)
+        waiter = asyncio.ensure_future(pool.submit(job))
+        await asyncio.sleep(0.01)
+        assert pool.running == 1
+        waiter.cancel()
+        await asyncio.sleep(0.01)
+        assert cancelled == [job.id] and pool.running == 0
+        await pool.stop()
+
+    asyncio.run(scenario())
+
+
+def test_results_nobody_waits_for_are_discarded():
+    async def scenario():
+        discarded = []
+
+        async def job(_=None):
+            # finishes even though it is cancelled, like a render that already wrote its file
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                return 'late'
+
+        flights = SingleFlight(discard=discarded.append)
+        waiter = asyncio.ensure_future(flights.run('key', job))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.sleep(0.01)
+        assert discarded == ['late']
+
+        pool = WorkerPool(LocalJobQueue(), job, workers=1, discard=discarded.append)
+        pool.start()
+        waiter = asyncio.ensure_future(pool.submit(ClipJob(Request('C0DPdy98e4c', 5, 15), 'video', 'clip',
+                                                           chat_id=1, user_id=1)))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.sleep(0.01)
+        assert discarded == ['late', 'late']
+        await pool.stop()
+
+    asyncio.run(scenario())
+
+
+def test_sqlite_store_is_shared_and_bounded(tmp_path):
+    path = str(tmp_path / 'state.sqlite3')
+    store = SQLiteStore(path, 'last_messages', maxsize=2, ttl=60)
+    other = SQLiteStore(path, 'last_messages', maxsize=2, ttl=60)
+
+    store[(1, 10)] = 100
+    assert other[(1, 10)] == 100
+    assert (1, 11) not in other
+
+    store[(1, 11)] = 101
+    store[(1, 12)] = 102
+    assert len(other) == 2
+    assert other.get((1, 10)) is None
+
+
+def test_message_store_is_bounded_and_persistent(tmp_path):
+    path = str(tmp_path / 'last_messages')
+    # four generations of 8 slots, 5 of them usable each
+    store = MessageStore(4 * (HEADER.size + 8 * SLOT.size), path=path)
+    chat_id = -1001234567890
+
+    for message_id in range(1, 13):
+        store[(chat_id, message_id)] = 1000 + message_id
+    store[(chat_id, 1)] = 2001
+    assert store[(chat_id, 1)] == 2001 and len(store) == 12
+    del store[(chat_id, 2)]
+    assert (chat_id, 2) not in store and len(store) == 11
+
+    # message 3 is read, so it moves along when its generation is dropped
+    assert store[(chat_id, 3)] == 1003
+    for message_id in range(13, 26):
+        store[(chat_id, message_id)] = 1000 + message_id
+    assert store[(chat_id, 3)] == 1003 and (chat_id, 4) not in store
+    # a membership check is not a read, it neither counts nor promotes
+    stats = (store.stats.hits, store.stats.misses, store.stats.promoted)
+    assert (chat_id, 13) in store
+    assert (store.stats.hits, store.stats.misses, store.stats.promoted) == stats
+    assert store.nbytes <= store.max_bytes and store.stats.evicted > 0
+    entries = dict(store.items())
+    store.close()
+
+    reopened = MessageStore(store.max_bytes, path=path)
+    assert dict(reopened.items()) == entries
+    assert reopened[(chat_id, 25)] == 1025
+
+
+def test_message_store_with_tiny_tables_finds_missing_keys():
+    for capacity in (2, 3, 4):
+        store = MessageStore(2 * (HEADER.size + capacity * SLOT.size), generations=2)
+        for message_id in range(1, 10):
+            store[(1, message_id)] = message_id
+            # a miss probes until an empty slot, so a table is never filled up
+            assert (2, message_id) not in store
+        assert store[(1, 9)] == 9
+
+
+@pytest.mark.parametrize('state_backend, last_messages_backend',
+                         [('memory', 'compact'), ('sqlite', 'memory'), ('memory', 'sqlite')])
+def test_app_imports_with_each_state_backend(tmp_path, state_backend, last_messages_backend):
+    (tmp_path / 'config.py').write_text(f"TOKEN = '1:a'\nBOT_CHANNEL_ID = -1\n"
+                                        f"STATE_BACKEND = {state_backend!r}\n"
+                                        f"LAST_MESSAGES_BACKEND = {last_messages_backend!r}\n")
+    code = 'import app, formats; print(type(app.make_last_messages()).__name__, type(formats._cache).__name__)'
+    path = os.pathsep.join([str(tmp_path), os.path.dirname(os.path.abspath(__file__))])
+    result = subprocess.run([sys.executable, '-c', code], cwd=tmp_path, capture_output=True, text=True,
+                            env={**os.environ, 'PYTHONPATH': path})
+    assert result.returncode == 0, result.stderr
+    stores = {'compact': 'MessageStore', 'memory': 'TTLCache', 'sqlite': 'SQLiteStore'}
+    assert result.stdout.split() == [stores[last_messages_backend], stores[state_backend]]
+
+
+def test_process_cache_dir_removes_only_its_own_stale_directories(tmp_path):
+    for name in ('12345', 'shard-0', 'shard-3', 'MainProcess', 'other-app', 'shard-x'):
+        (tmp_path / name).mkdir()
+    (tmp_path / '678').write_text('not a directory')
+
+    assert app.process_cache_dir(str(tmp_path), 0, 2) == str(tmp_path / 'MainProcess')
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['678', 'other-app', 'shard-0', 'shard-x']
+
+
+def test_shard_of():
+    message = {'message': {'chat': {'id': 7}}}
+    callback = {'callback_query': {'from': {'id': 9}}}
+    assert shard_of(message, 4) == 3
+    assert shard_of(callback, 4) == 1
+    assert shard_of({'poll': {}}, 4) == 0
+
+
+def test_choose_profile_by_duration():
+    short = choose_profile('clip', 30)
+    long = choose_profile('clip', 600)
+    assert short.max_height > long.max_height
+    assert choose_profile('clip', 10_000) == long
+    assert choose_profile('preview', 30).max_height <= long.max_height
+
+
+def test_select_video_format_fits_profile_and_upload_limit():
+    candidates = [
+        {'url': '360p', 'height': 360, 'tbr': 500},
+        {'url': '720p', 'height': 720, 'tbr': 2500},
+        {'url': '1080p', 'height': 1080, 'tbr': 5000},
+    ]
+    assert select_video_format(candidates, EncodingProfile(max_height=1080), 30)['url'] == '1080p'
+    assert select_video_format(candidates, EncodingProfile(max_height=720), 30)['url'] == '720p'
+    assert select_video_format(candidates, EncodingProfile(max_height=1080), 600)['url'] == '360p'
+    assert select_video_format(candidates, EncodingProfile(max_height=240), 30)['url'] == '360p'
+
+
+def test_source_cache_serves_overlapping_ranges_from_disk(tmp_path):
+    blob = bytes(range(256)) * 40
+    upstream_requests = []
+
+    async def upstream(request):
+        start, end = parse_range(request.headers['Range'], len(blob))
+        upstream_requests.append((start, end))
+        return web.Response(status=206, body=blob[start:end + 1],
+                            headers={'Content-Range': f'bytes {start}-{end}/{len(blob)}'})
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get('/videoplayback', upstream)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 0).start()
+        host, port = runner.addresses[0][:2]
+
+        cache = SourceCache(str(tmp_path), max_bytes=10 * 1024, block_size=1024)
+        await cache.start()
+        url = cache.source_url('C0DPdy98e4c', f'http://{host}:{port}/videoplayback?itag=18&expire=1')
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url, headers={'Range': 'bytes=1000-4999'}) as response:
+                assert response.status == 206
+                assert await response.read() == blob[1000:5000]
+            fetched = len(upstream_requests)
+
+            async with session.get(url, headers={'Range': 'bytes=2000-5999'}) as response:
+                assert await response.read() == blob[2000:6000]
+            assert len(upstream_requests) == fetched + 1
+
+            async with session.get(url) as response:
+                assert await response.read() == blob
+
+        assert cache.size <= 10 * 1024
+        await cache.stop()
+        await runner.cleanup()
+
+    asyncio.run(scenario())
+
+
+def test_speculator_budget_claims_and_waste():
+    async def scenario():
+        async def job():
+            await asyncio.sleep(1)
+
+        speculator = Speculator(budget=2, ttl=0.01)
+        assert speculator.speculate('a', owner=1, make_job=job)
+        assert speculator.speculate('b', owner=2, make_job=job)
+        assert not speculator.speculate('c', owner=3, make_job=job)
+
+        # a newer query from the same owner replaces the older speculation
+        assert speculator.speculate('a2', owner=1, make_job=job)
+        assert 'a' not in speculator
+
+        assert speculator.claim('a2')
+        assert not speculator.claim('c')
+        await asyncio.sleep(0.05)
+        assert 'b' not in speculator
+
+        stats = speculator.stats
+        assert (stats.started, stats.over_budget, stats.hits, stats.misses) == (3, 1, 1, 1)
+        assert (stats.wasted, stats.cancelled) == (2, 2)
+        assert stats.hit_rate == 0.5
+
+    asyncio.run(scenario())
+
+
+def test_format_cache_shares_extractions_and_honours_url_expiry(monkeypatch):
+    extractions = []
+    expire = {'C0DPdy98e4c': time() + 10 * 60, 'Bx51eegLTY8': time() + formats.URL_EXPIRY_MARGIN - 1}
+
+    async def extract_info(url):
+        youtube_id = url.rsplit('/', 1)[1]
+        extractions.append(youtube_id)
+        await asyncio.sleep(0.01)
+        return {'formats': [
+            {'ext': 'mp4', 'acodec': 'mp4a', 'vcodec': 'avc1', 'height': 360, 'tbr': 500,
+             'url': f'https://r1.googlevideo.com/videoplayback?itag=18&expire={int(expire[youtube_id])}'},
+            {'ext': 'm4a', 'acodec': 'mp4a', 'vcodec': 'none', 'tbr': 128,
+             'url': f'https://r1.googlevideo.com/videoplayback?itag=140&expire={int(expire[youtube_id])}'},
+        ]}
+
+    monkeypatch.setattr(formats, 'extract_info', extract_info)
+    monkeypatch.setattr(formats, '_cache', TTLCache(maxsize=10, ttl=60 * 60))
+    monkeypatch.setattr(formats, 'stats', formats.FormatCacheStats())
+
+    async def scenario():
+        # one extraction serves every caller and every format type of the video
+        clips = await asyncio.gather(*[formats.get_candidate_formats('C0DPdy98e4c', 'clip') for _ in range(3)])
+        assert [len(c) for c in clips] == [1] * 3 and extractions == ['C0DPdy98e4c']
+        assert (await formats.get_candidate_formats('C0DPdy98e4c', 'audio'))[0]['ext'] == 'm4a'
+        expires_at, _ = formats._cache[('C0DPdy98e4c', 'clip')]
+        assert expires_at == pytest.approx(expire['C0DPdy98e4c'] - formats.URL_EXPIRY_MARGIN, abs=1)
+
+        # a URL that expires within the margin is extracted again on every lookup
+        await formats.get_candidate_formats('Bx51eegLTY8', 'clip')
+        await formats.get_candidate_formats('Bx51eegLTY8', 'clip')
+        assert extractions == ['C0DPdy98e4c', 'Bx51eegLTY8', 'Bx51eegLTY8']
+
+        stats = formats.stats
+        assert (stats.hits, stats.misses, stats.coalesced, stats.expired) == (1, 5, 2, 1)
+
+    asyncio.run(scenario())
+
+
+def test_segment_cache_reuses_same_start_and_source(tmp_path):
+    clip = tmp_path / 'clip.mp4'
+    clip.write_bytes(b'x' * 1000)
+    profile = choose_profile('clip', 30)
+    cache = SegmentCache(str(tmp_path / 'segments'), max_bytes=1500)
+
+    cache.put('a', str(clip), 40, 'itag22', profile)
+    assert cache.find('a', 10, 45, 'itag22', profile).end == 40
+    assert cache.find('a', 10, 35, 'itag18', profile) is not None
+    assert cache.find('a', 10, 45, 'itag18', profile) is None
+    # a trim is a new render in the profile of its own length
+    assert cache.find('a', 10, 35, 'itag22', choose_profile('clip', 300)) is None
+
+    cache.put('b', str(clip), 40, 'itag22', profile)
+    assert len(cache) == 1 and cache.find('a', 10, 45, 'itag22', profile) is None
+    assert cache.stats.evicted == 1
+
+
+def test_segment_cache_extends_in_the_segments_profile(tmp_path):
+    minute = tmp_path / 'minute.mp4'
+    with open(minute, 'wb') as f:
+        f.truncate(30 * 10 ** 6)
+    profile = choose_profile('clip', 60)
+    cache = SegmentCache(str(tmp_path / 'segments'), max_bytes=10 ** 9)
+    cache.put('a', str(minute), 60, 'itag22', profile)
+
+    # 65s would be rendered in the next profile, the segment's is kept
+    assert choose_profile('clip', 65) != profile
+    assert cache.find('a', 0, 65, 'itag22', choose_profile('clip', 65)).profile == profile
+    # as long as the estimate for the whole clip stays within the upload limit
+    assert cache.find('a', 0, 300, 'itag22', choose_profile('clip', 300)) is None
+
+
+def test_frame_cache_renders_and_uploads_once():
+    async def scenario():
+        rendered, uploaded = [], []
+
+        async def render(youtube_id, second):
+            rendered.append((youtube_id, second))
+            await asyncio.sleep(0.01)
+            return b'photo', b'thumb'
+
+        async def upload(photo):
+            uploaded.append(photo)
+            return f'file-{len(uploaded)}'
+
+        frames = FrameCache(2, render, upload)
+        assert frames.cached_file_id('a', 10) is None
+        assert await asyncio.gather(*[frames.file_id('a', 10) for _ in range(3)]) == ['file-1'] * 3
+        assert rendered == [('a', 10)] and len(uploaded) == 1
+        assert frames.cached_file_id('a', 10) == 'file-1'
+        assert (await frames.get('a', 10)).thumb == b'thumb'
+
+        await frames.get('b', 10)
+        await frames.get('a', 10)
+        await frames.get('c', 10)
+        # 'a' was used more recently than 'b'
+        assert frames.peek('a', 10).file_id == 'file-1' and frames.peek('b', 10) is None
+        assert (frames.stats.hits, frames.stats.misses, frames.stats.evicted) == (2, 5, 1)
+
+    asyncio.run(scenario())
+
+
+def test_inline_keystrokes_prefetch_only_the_last_frame(monkeypatch):
+    async def scenario():
+        rendered, uploaded = [], []
+
+        async def render(youtube_id, second):
+            rendered.append(second)
+            await asyncio.sleep(0.01)
+            return b'photo', b'thumb'
+
+        async def upload(photo):
+            uploaded.append(photo)
+            return 'file'
+
+        monkeypatch.setattr(app, 'frames', FrameCache(8, render, upload), raising=False)
+        monkeypatch.setattr(app, 'frame_prefetches', Debouncer(delay=0.02), raising=False)
+        # a user types the start second by second, another user asks meanwhile
+        for second in range(1, 6):
+            app.prefetch_frame(Request('C0DPdy98e4c', second, second + 10), user_id=1)
+            await asyncio.sleep(0.005)
+        app.prefetch_frame(Request('C0DPdy98e4c', 30, 40), user_id=2)
+        await asyncio.sleep(0.1)
+
+        assert sorted(rendered) == [5, 30] and len(uploaded) == 2
+        assert app.frames.cached_file_id('C0DPdy98e4c', 5) == 'file'
+
+    asyncio.run(scenario())
+
+
+def test_api_scheduler_collapses_edits_and_retries():
+    async def scenario():
+        sent = []
+
+        def edit(caption, fail=0):
+            async def make_request():
+                nonlocal fail
+                if fail:
+                    fail -= 1
+                    raise RetryAfter(0.01)
+                sent.append(caption)
+                return caption
+            return make_request
+
+        scheduler = ApiScheduler(rate=100, chat_rate=100, chat_burst=1)
+        data = {'inline_message_id': 'a'}
+        first = await scheduler.call('editMessageCaption', data, edit('0'))
+        # '1' waits for a token, '2' and '3' replace it before it is sent
+        results = await asyncio.gather(*[scheduler.call('editMessageCaption', data, edit(str(i)))
+                                         for i in range(1, 4)])
+        assert first == '0' and results == ['3'] * 3 and sent == ['0', '3']
+        assert scheduler.stats.collapsed == 2
+
+        assert await scheduler.call('sendMessage', {'chat_id': 1}, edit('4', fail=2)) == '4'
+        assert (scheduler.stats.retried, scheduler.stats.sent) == (2, 3)
+        with pytest.raises(RetryAfter):
+            await scheduler.call('sendMessage', {'chat_id': 1}, edit('5', fail=4))
+
+        # chat actions do not use the chat's tokens
+        assert await scheduler.call('sendChatAction', {'chat_id': 1}, edit('typing')) == 'typing'
+        assert scheduler.stats.sent == 3
+
+    asyncio.run(scenario())
+
+
+def test_scheduled_bot_retries_an_upload_with_the_file_opened_again(tmp_path):
+    video = tmp_path / 'clip.mp4'
+    video.write_bytes(b'video' * 1000)
+    uploads = []
+
+    async def api(request):
+        form = await request.post()
+        uploads.append((form['video'].filename, form['video'].file.read()))
+        if len(uploads) != 2:
+            return web.json_response({'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                                      'parameters': {'retry_after': 1}}, status=429)
+        return web.json_response({'ok': True, 'result': {'message_id': len(uploads), 'date': 0,
+                                                         'chat': {'id': 1, 'type': 'private'}}})
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', api)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 0).start()
+        host, port = runner.addresses[0][:2]
+
+        scheduler = ApiScheduler(rate=100, chat_rate=100)
+        bot = ScheduledBot(token='1:a', scheduler=scheduler,
+                           server=TelegramAPIServer.from_base(f'http://{host}:{port}'))
+        with open(video, 'rb') as f:
+            assert await bot.send_video(1, InputFile(f, filename='clip.mp4'))
+        assert uploads == [('clip.mp4', video.read_bytes())] * 2
+        assert scheduler.stats.retried == 1
+
+        # an upload from memory cannot be read again, it is sent only once
+        with pytest.raises(RetryAfter):
+            await bot.send_video(1, InputFile(BytesIO(b'video'), filename='clip.mp4'))
+        assert len(uploads) == 3
+
+        await bot.session.close()
+        await runner.cleanup()
+
+    asyncio.run(scenario())
+
+
+def test_encoder_slots_bound_the_wait_list_and_count_outcomes():
+    async def scenario():
+        slots = EncoderSlots(workers=1, queue_size=1)
+        release = asyncio.Event()
+
+        async def run(fail=False):
+            async with slots.slot():
+                await release.wait()
+                if fail:
+                    raise RuntimeError('ffmpeg failed')
+
+        running = asyncio.ensure_future(run())
+        waiting = asyncio.ensure_future(run(fail=True))
+        await asyncio.sleep(0.01)
+        assert (slots.stats.running, slots.stats.queued) == (1, 1)
+        with pytest.raises(EncoderBusy):
+            await run()
+
+        release.set()
+        await running
+        with pytest.raises(RuntimeError):
+            await waiting
+        stats = slots.stats
+        assert (stats.finished, stats.failed, stats.rejected, stats.running, stats.queued) == (1, 1, 1, 0, 0)
+        # the second run waited while the first one ran
+        assert stats.wait_seconds > 0.005 and stats.run_seconds > 0.005
+
+    asyncio.run(scenario())
+
+
+def test_encoder_slots_do_not_reject_accepted_work():
+    async def scenario():
+        slots = EncoderSlots(workers=2, queue_size=8)
+
+        async def piece():
+            async with slots.slot():
+                await asyncio.sleep(0.01)
+
+        async def job(accept):
+            if accept:
+                with accepted():
+                    # like the head, middle, tail and audio of a smart cut
+                    await asyncio.gather(*[piece() for _ in range(4)])
+            else:
+                await asyncio.gather(*[piece() for _ in range(4)])
+
+        results = await asyncio.gather(*[job(False) for _ in range(4)], return_exceptions=True)
+        assert sum(isinstance(r, EncoderBusy) for r in results) == 2
+        assert slots.stats.rejected == 6
+        await asyncio.sleep(0.05)
+
+        assert await asyncio.gather(*[job(True) for _ in range(4)]) == [None] * 4
+        assert slots.stats.rejected == 6 and slots.stats.queued == slots.stats.running == 0
+
+    asyncio.run(scenario())
+
+
+def test_debouncer_runs_only_the_newest_job():
+    async def scenario():
+        applied = []
+        cancelled = []
+
+        def job(name, duration):
+            async def run():
+                try:
+                    await asyncio.sleep(duration)
+                except asyncio.CancelledError:
+                    cancelled.append(name)
+                    raise
+                applied.append(name)
+            return run
+
+        debouncer = Debouncer(delay=0.01)
+        # 'waiting' is replaced during its delay, 'running' while it runs
+        waiting = asyncio.ensure_future(debouncer.run('message', job('waiting', 0)))
+        await asyncio.sleep(0)
+        running = asyncio.ensure_future(debouncer.run('message', job('running', 1), delay=0))
+        await asyncio.sleep(0.02)
+        assert await asyncio.gather(waiting, running, debouncer.run('message', job('newest', 0))) == \
+            [False, False, True]
+        assert applied == ['newest'] and cancelled == ['running']
+        assert 'message' not in debouncer
+        assert (debouncer.stats.started, debouncer.stats.superseded, debouncer.stats.finished) == (3, 2, 1)
+
+    asyncio.run(scenario())
+
+
+def test_debouncer_lets_a_started_upload_finish():
+    async def scenario():
+        events = []
+
+        async def upload():
+            events.append('upload')
+            await asyncio.sleep(0.02)
+            events.append('recorded')
+
+        async def old():
+            await finish(upload())
+            events.append('after upload')
+
+        async def new():
+            events.append('new')
+
+        debouncer = Debouncer(delay=0)
+        running = asyncio.ensure_future(debouncer.run('message', old))
+        await asyncio.sleep(0.01)
+        # the newer job cancels the old one halfway through its upload
+        assert await asyncio.gather(running, debouncer.run('message', new)) == [False, True]
+        assert events == ['upload', 'recorded', 'new']
+
+    asyncio.run(scenario())
+
+
+def test_metrics_render_prometheus_text():
+    registry = Registry()
+    stages = Histogram('stage_seconds', 'Stage latency.', labels=('stage',), buckets=(0.1, 1), registry=registry)
+    Counter('updates_total', 'Updates.', labels=('type',), registry=registry).inc(type='message')
+    Gauge('queue_depth', 'Queue depth.', function=lambda: 3, registry=registry)
+    StatsCollector('cache', 'Cache.', SpeculationStats(hits=2), registry=registry)
+
+    stages.observe(0.05, stage='cut')
+    stages.observe(0.5, stage='cut')
+    stages.observe(5, stage='cut')
+
+    lines = registry.render().splitlines()
+    assert '# TYPE stage_seconds histogram' in lines
+    assert 'stage_seconds_bucket{stage="cut",le="0.1"} 1' in lines
+    assert 'stage_seconds_bucket{stage="cut",le="1"} 2' in lines
+    assert 'stage_seconds_bucket{stage="cut",le="+Inf"} 3' in lines
+    assert 'stage_seconds_sum{stage="cut"} 5.55' in lines
+    assert 'stage_seconds_count{stage="cut"} 3' in lines
+    assert 'updates_total{type="message"} 1' in lines
+    assert 'queue_depth 3' in lines
+    assert 'cache{field="hits"} 2' in lines
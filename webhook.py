@@ -0,0 +1,75 @@
+import asyncio
+import signal
+from typing import Awaitable, Callable
+
+from aiogram import Dispatcher
+from aiogram.utils import executor
+from aiohttp import web
+
+import config
+from metrics import metrics_handler
+
+WEBHOOK_HOST: str = getattr(config, 'WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT: int = getattr(config, 'WEBHOOK_PORT', 8080)
+WEBHOOK_PATH: str = getattr(config, 'WEBHOOK_PATH', '/webhook')
+# public address Telegram should post updates to, e.g. https://example.com/webhook
+WEBHOOK_URL: str = getattr(config, 'WEBHOOK_URL', None)
+# how long /readyz fails before the port closes, so that health checks get to see it
+READY_GRACE: float = getattr(config, 'WEBHOOK_READY_GRACE', 5)
+
+Hook = Callable[[Dispatcher], Awaitable[None]]
+
+
+async def healthz(request: web.Request) -> web.Response:
+    return web.Response(text='ok')
+
+
+async def readyz(request: web.Request) -> web.Response:
+    if request.app['ready']:
+        return web.Response(text='ready')
+    return web.Response(status=503, text='not ready')
+
+
+def make_web_app() -> web.Application:
+    app = web.Application()
+    app['ready'] = False
+    app.router.add_get('/healthz', healthz)
+    app.router.add_get('/readyz', readyz)
+    app.router.add_get('/metrics', metrics_handler())
+    return app
+
+
+async def serve(app: web.Application, dispatcher: Dispatcher, on_shutdown: Hook,
+                host: str, port: int, stop: Awaitable, ready_grace: float = READY_GRACE) -> None:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    try:
+        await stop
+        # stop taking traffic first so a load balancer moves on to other replicas,
+        # the port stays open until the running jobs are drained
+        app['ready'] = False
+        await asyncio.gather(on_shutdown(dispatcher), asyncio.sleep(ready_grace))
+    finally:
+        await runner.cleanup()
+
+
+def start_webhook(dispatcher: Dispatcher, loop: asyncio.AbstractEventLoop,
+                  on_startup: Hook, on_shutdown: Hook,
+                  host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT,
+                  path: str = WEBHOOK_PATH, url: str = WEBHOOK_URL) -> None:
+    app = make_web_app()
+
+    async def startup(dispatcher: Dispatcher):
+        await on_startup(dispatcher)
+        if url is not None:
+            await dispatcher.bot.set_webhook(url)
+        app['ready'] = True
+
+    # aiohttp's run_app closes the port before any shutdown hook runs, so the
+    # server is run here and on_shutdown is called while it still serves
+    executor.set_webhook(dispatcher, path, loop=loop, on_startup=startup, web_app=app)
+    stopping = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+    loop.run_until_complete(serve(app, dispatcher, on_shutdown, host, port, stopping.wait()))